@@ -0,0 +1,24 @@
+import asyncio
+
+
+class AsyncService():
+    """Asyncio variant of a service object (Toggl, FreshBooks, Zendesk).
+    Every method of the wrapped service becomes a coroutine that runs in a worker thread,
+    while a semaphore limits how many calls to that service run at the same time."""
+
+    def __init__(self, service, name):
+        self.service = service
+        self.limit = service.async_limits.get(name, service.workers)
+        self.semaphore = None  # created on first call, so it belongs to the running event loop
+
+    def __getattr__(self, name):
+        attribute = getattr(self.service, name)
+        if not callable(attribute):
+            return attribute
+
+        async def call(*args, **kwargs):
+            if self.semaphore is None:
+                self.semaphore = asyncio.Semaphore(self.limit)
+            async with self.semaphore:
+                return await asyncio.to_thread(attribute, *args, **kwargs)
+        return call
@@ -0,0 +1,321 @@
+"""Local stand-ins for the Toggl, FreshBooks and Zendesk APIs, used by the benchmarks.
+Only implements the endpoints (and the parts of the responses) this project uses."""
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit, parse_qs, urlencode
+from xml.sax.saxutils import escape
+import datetime
+import json
+import random
+import re
+import threading
+import time
+
+
+class FakeData():
+    """Generated dataset served by the fake APIs."""
+
+    WORDS = ['acme', 'globex', 'initech', 'umbrella', 'hooli', 'stark', 'wayne', 'wonka', 'tyrell',
+             'cyberdyne', 'soylent', 'vandelay', 'support', 'hosting', 'migration', 'design', 'audit']
+
+    def __init__(self, projects=10000, clients=500, entries=50000, tickets=1000, days=90, seed=42):
+        rand = random.Random(seed)
+        now = datetime.datetime.now(datetime.timezone.utc).replace(microsecond=0)
+        self.lock = threading.Lock()
+        self.clients = [{'id': i + 1, 'name': '%s %s %i' % (rand.choice(self.WORDS).title(),
+                                                             rand.choice(self.WORDS).title(), i)}
+                        for i in range(clients)]
+        self.projects = [{'id': i + 1, 'name': '#%i %s %s' % (100000 + i, rand.choice(self.WORDS),
+                                                             rand.choice(self.WORDS)),
+                          'cid': rand.randint(1, clients), 'wid': 1}
+                         for i in range(projects)]
+        self.fb_projects = [{'project_id': i + 1, 'name': '%s - %s' % (client['name'], rand.choice(self.WORDS))}
+                            for i, client in enumerate(self.clients)]
+        self.time_entries = []
+        for i in range(entries):
+            start = now - datetime.timedelta(seconds=rand.randint(0, days * 24 * 60 * 60))
+            self.time_entries.append({
+                'id': i + 1,
+                'pid': rand.randint(1, projects),
+                'start': start.isoformat(),
+                'duration': rand.randint(5, 240) * 60,
+                'description': rand.choice(self.WORDS),
+                'billable': rand.random() < 0.8,
+                'tags': [],
+                })
+        self.time_entries.sort(key=lambda entry: entry['start'])
+        self.time_entries_by_id = {entry['id']: entry for entry in self.time_entries}
+        self.organizations = [{'id': i + 1, 'name': client['name']} for i, client in enumerate(self.clients)]
+        self.tickets = []
+        for i in range(tickets):
+            created = now - datetime.timedelta(seconds=rand.randint(0, days * 24 * 60 * 60))
+            self.tickets.append({
+                'id': 200000 + i,
+                'subject': '%s %s' % (rand.choice(self.WORDS), rand.choice(self.WORDS)),
+                'organization_id': rand.randint(1, clients),
+                'status': 'open',
+                'created_at': created.strftime('%Y-%m-%dT%H:%M:%SZ'),
+                'updated_at': created.strftime('%Y-%m-%dT%H:%M:%SZ'),
+                'generated_timestamp': int(created.timestamp()),
+                })
+        self.tickets.sort(key=lambda ticket: ticket['generated_timestamp'])
+        self.fb_time_entries = []
+
+
+class FakeHandler(BaseHTTPRequestHandler):
+    """Handles requests for all three fake APIs, based on path."""
+
+    protocol_version = 'HTTP/1.1'  # keep-alive, like the real APIs
+    disable_nagle_algorithm = True  # headers and body are written separately, don't wait for delayed ACKs
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        self.handle_request('GET')
+
+    def do_POST(self):
+        self.handle_request('POST')
+
+    def handle_request(self, method):
+        server = self.server
+        length = int(self.headers.get('Content-Length') or 0)
+        body = self.rfile.read(length).decode('utf-8') if length else ''
+        if server.latency:
+            time.sleep(server.latency)
+        if len(self.path) > server.url_limit:
+            return self.respond(414, {'error': 'URI Too Long'})
+        if not server.allow_request():
+            return self.respond(429, {'error': 'Too many requests'}, headers={'Retry-After': '1'})
+        url = urlsplit(self.path)
+        params = {key: values[0] for key, values in parse_qs(url.query).items()}
+        for pattern, handler in ROUTES:
+            match = re.match(pattern + '$', method + ' ' + url.path)
+            if match:
+                status, response = handler(server.data, server, params, body, *match.groups())
+                return self.respond(status, response)
+        self.respond(404, {'error': 'Not found: %s %s' % (method, url.path)})
+
+    def respond(self, status, response, headers=None):
+        if isinstance(response, str):
+            payload, content_type = response.encode('utf-8'), 'application/xml'
+        else:
+            payload, content_type = json.dumps(response).encode('utf-8'), 'application/json'
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(payload)))
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(payload)
+
+
+class FakeServer(ThreadingHTTPServer):
+    """Fake API server with configurable latency, page size and rate limit."""
+
+    daemon_threads = True
+
+    def __init__(self, data, latency=0.0, page_size=100, rate_limit=None, entry_limit=1000, url_limit=8192):
+        super(FakeServer, self).__init__(('127.0.0.1', 0), FakeHandler)
+        self.data = data
+        self.latency = latency  # seconds added to every request
+        self.page_size = page_size  # max results per page for Zendesk
+        self.rate_limit = rate_limit  # max requests per second, None for unlimited
+        self.entry_limit = entry_limit  # max number of Toggl time entries per request
+        self.url_limit = url_limit  # max URL length, longer URLs are rejected like real servers do
+        self.requests = []  # request timestamps within the last second
+        self.lock = threading.Lock()
+
+    @property
+    def url(self):
+        return 'http://127.0.0.1:%i' % self.server_port
+
+    def allow_request(self):
+        """Returns False if rate limit is exceeded."""
+        if not self.rate_limit:
+            return True
+        with self.lock:
+            now = time.time()
+            self.requests = [t for t in self.requests if now - t < 1]
+            if len(self.requests) >= self.rate_limit:
+                return False
+            self.requests.append(now)
+            return True
+
+    def start(self):
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self
+
+
+# Toggl
+
+def toggl_me(data, server, params, body):
+    since = int(params.get('since', 0))
+    projects = [p for p in data.projects if p.get('at', 0) >= since]  # generated projects have no 'at'
+    return 200, {'since': int(time.time()), 'data': {'projects': projects, 'clients': data.clients}}
+
+
+def toggl_clients(data, server, params, body):
+    return 200, data.clients
+
+
+def toggl_create_client(data, server, params, body):
+    client = json.loads(body)['client']
+    with data.lock:
+        if any(c['name'] == client['name'] for c in data.clients):
+            return 400, 'Name has already been taken'  # like Toggl
+        client['id'] = len(data.clients) + 1
+        data.clients.append(client)
+    return 200, {'data': client}
+
+
+def toggl_project(data, server, params, body, project_id):
+    project_id = int(project_id)
+    if 0 < project_id <= len(data.projects):
+        return 200, {'data': data.projects[project_id - 1]}
+    return 404, {'data': None}
+
+
+def toggl_create_project(data, server, params, body):
+    project = json.loads(body)['project']
+    with data.lock:
+        project['id'] = len(data.projects) + 1
+        project['at'] = int(time.time())
+        data.projects.append(project)
+    return 200, {'data': project}
+
+
+def toggl_time_entries(data, server, params, body):
+    start = params.get('start_date', '')
+    end = params.get('end_date', '9999')
+    entries = [e for e in data.time_entries if start <= e['start'] < end]
+    return 200, entries[-server.entry_limit:]  # like Toggl, only the last entries are returned
+
+
+def toggl_tag(data, server, params, body, ids):
+    tags = json.loads(body)['time_entry']['tags']
+    remove = json.loads(body)['time_entry'].get('tag_action') == 'remove'
+    entries = []
+    for entry_id in ids.split(','):
+        entry = data.time_entries_by_id[int(entry_id)]
+        entry['tags'] = sorted(set(entry['tags']) - set(tags) if remove else set(entry['tags']) | set(tags))
+        entries.append(entry)
+    return 200, {'data': entries}
+
+
+def toggl_workspaces(data, server, params, body):
+    return 200, [{'id': 1, 'name': 'Workspace'}]
+
+
+# FreshBooks
+
+def freshbooks(data, server, params, body):
+    method = re.search(r'method="([\w.]+)"', body).group(1)
+    value = lambda tag, default=None: (re.search(r'<%s>(.*?)</%s>' % (tag, tag), body, re.S) or [None, default])[1]
+    if method == 'project.list':
+        page, per_page = int(value('page', 1)), int(value('per_page', 25))
+        projects = data.fb_projects[(page - 1) * per_page:page * per_page]
+        pages = (len(data.fb_projects) + per_page - 1) // per_page
+        items = ''.join('<project><project_id>%i</project_id><name>%s</name><tasks><task><task_id>2</task_id>'
+                        '</task></tasks></project>' % (p['project_id'], escape(p['name'])) for p in projects)
+        return 200, ('<?xml version="1.0" encoding="utf-8"?><response xmlns="http://www.freshbooks.com/api/" '
+                     'status="ok"><projects page="%i" per_page="%i" pages="%i" total="%i">%s</projects></response>'
+                     % (page, per_page, pages, len(data.fb_projects), items))
+    elif method == 'time_entry.create':
+        with data.lock:
+            entry = {
+                'time_entry_id': (data.fb_time_entries[-1]['time_entry_id'] if data.fb_time_entries else 0) + 1,
+                'project_id': value('project_id'),
+                'task_id': value('task_id'),
+                'hours': value('hours'),
+                'notes': value('notes', '').replace('<![CDATA[', '').replace(']]>', ''),
+                'date': value('date'),
+                }
+            data.fb_time_entries.append(entry)
+        return 200, ('<?xml version="1.0" encoding="utf-8"?><response xmlns="http://www.freshbooks.com/api/" '
+                     'status="ok"><time_entry_id>%i</time_entry_id></response>' % entry['time_entry_id'])
+    elif method == 'time_entry.list':
+        page, per_page = int(value('page', 1)), int(value('per_page', 25))
+        date_from, date_to = value('date_from', ''), value('date_to', '9999')
+        entries = [e for e in data.fb_time_entries if date_from <= e['date'] <= date_to]
+        pages = (len(entries) + per_page - 1) // per_page
+        items = ''.join('<time_entry><time_entry_id>%i</time_entry_id><project_id>%s</project_id>'
+                        '<task_id>%s</task_id><hours>%s</hours><date>%s</date><notes>%s</notes></time_entry>'
+                        % (e['time_entry_id'], e['project_id'], e['task_id'], e['hours'], e['date'],
+                           escape(e['notes'])) for e in entries[(page - 1) * per_page:page * per_page])
+        return 200, ('<?xml version="1.0" encoding="utf-8"?><response xmlns="http://www.freshbooks.com/api/" '
+                     'status="ok"><time_entries page="%i" per_page="%i" pages="%i" total="%i">%s</time_entries>'
+                     '</response>' % (page, per_page, pages, len(entries), items))
+    elif method == 'time_entry.delete':
+        time_entry_id = int(value('time_entry_id'))
+        with data.lock:
+            data.fb_time_entries = [e for e in data.fb_time_entries if e['time_entry_id'] != time_entry_id]
+        return 200, ('<?xml version="1.0" encoding="utf-8"?><response xmlns="http://www.freshbooks.com/api/" '
+                     'status="ok"></response>')
+    return 200, '<response status="fail"><error>Unknown method</error></response>'
+
+
+# Zendesk
+
+def zendesk_sideload(data, params, response, tickets):
+    """Adds organizations of tickets to response if they're sideloaded."""
+    if 'organizations' in params.get('include', ''):
+        ids = sorted(set(t['organization_id'] for t in tickets if t.get('organization_id')))
+        response['organizations'] = [data.organizations[i - 1] for i in ids]
+    return 200, response
+
+
+def zendesk_search(data, server, params, body):
+    page = int(params.get('page', 1))
+    created = re.search(r'created>(\S+)', params.get('query', ''))
+    tickets = data.tickets
+    if created:
+        tickets = [t for t in tickets if t['created_at'] > created.group(1)]
+    results = [dict(ticket, result_type='ticket') for ticket in
+               tickets[(page - 1) * server.page_size:page * server.page_size]]
+    next_page = None
+    if page * server.page_size < len(tickets):
+        next_page = '%s/api/v2/search.json?%s' % ('https://fake.zendesk.com', urlencode(
+            dict(params, page=page + 1)))
+    return zendesk_sideload(data, params, {'results': results, 'count': len(tickets), 'next_page': next_page},
+                            results)
+
+
+def zendesk_incremental(data, server, params, body):
+    cursor = int(params.get('cursor', 0))
+    if not cursor:
+        start_time = int(params.get('start_time', 0))
+        cursor = next((i for i, t in enumerate(data.tickets) if t['generated_timestamp'] >= start_time),
+                      len(data.tickets))
+    tickets = data.tickets[cursor:cursor + server.page_size]
+    end = cursor + server.page_size >= len(data.tickets)
+    query = dict((key, value) for key, value in params.items() if key == 'include')
+    after_url = None if end else 'https://fake.zendesk.com/api/v2/incremental/tickets/cursor.json?%s' % urlencode(
+        dict(query, cursor=cursor + server.page_size))
+    return zendesk_sideload(data, params, {'tickets': tickets, 'after_cursor': str(cursor + server.page_size),
+                                           'after_url': after_url, 'end_of_stream': end}, tickets)
+
+
+def zendesk_organization(data, server, params, body, organization_id):
+    return 200, {'organization': data.organizations[int(organization_id) - 1]}
+
+
+def zendesk_organizations(data, server, params, body):
+    ids = [int(i) for i in params.get('ids', '').split(',') if i]
+    return 200, {'organizations': [data.organizations[i - 1] for i in ids], 'next_page': None}
+
+
+ROUTES = [
+    (r'GET /api/v8/me', toggl_me),
+    (r'GET /api/v8/clients', toggl_clients),
+    (r'POST /api/v8/clients', toggl_create_client),
+    (r'GET /api/v8/projects/(\d+)', toggl_project),
+    (r'POST /api/v8/projects', toggl_create_project),
+    (r'GET /api/v8/time_entries', toggl_time_entries),
+    (r'POST /api/v8/time_entries/([\d,]+)', toggl_tag),
+    (r'GET /api/v8/workspaces', toggl_workspaces),
+    (r'POST /api/2.1/xml-in', freshbooks),
+    (r'GET /api/v2/search.json', zendesk_search),
+    (r'GET /api/v2/incremental/tickets/cursor.json', zendesk_incremental),
+    (r'GET /api/v2/organizations/(\d+).json', zendesk_organization),
+    (r'GET /api/v2/organizations/show_many.json', zendesk_organizations),
+    ]
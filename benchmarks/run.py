@@ -0,0 +1,141 @@
+"""Benchmarks the slow paths of WorkAutomation offline, against local fake APIs.
+
+Usage: python benchmarks/run.py [--latency 0.05] [--projects 10000] [--entries 50000] ...
+"""
+from urllib.parse import urlsplit
+import argparse
+import contextlib
+import io
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from requests.adapters import HTTPAdapter
+from fake_servers import FakeData, FakeServer
+
+
+class LocalAdapter(HTTPAdapter):
+    """Sends requests for the real APIs to the local fake server instead."""
+
+    def __init__(self, base_url, **kwargs):
+        super(LocalAdapter, self).__init__(**kwargs)
+        self.base_url = base_url
+
+    def send(self, request, **kwargs):
+        original_url = request.url
+        url = urlsplit(request.url)
+        request.url = self.base_url + url.path + ('?' + url.query if url.query else '')
+        response = super(LocalAdapter, self).send(request, **kwargs)
+        response.url = request.url = original_url  # pretend nothing happened
+        return response
+
+
+def write_config(directory):
+    """Writes config.json (and rules.json) for the fake APIs to directory."""
+    config = {
+        'zendesk_email': 'bench@example.com',
+        'zendesk_token': 'token',
+        'zendesk_subdomain': 'fake',
+        'toggl_token': 'token',
+        'freshbooks_token': 'token',
+        'freshbooks_subdomain': 'fake',
+        # The fake server has no per service limits, so the governor only adapts to its 429s:
+        'rate_limits': {'services': {service: {'rate': None} for service in ('toggl', 'zendesk', 'freshbooks')}},
+        }
+    with open(os.path.join(directory, 'config.json'), 'w') as config_file:
+        json.dump(config, config_file)
+    rules = [{'client': '.', 'match': 'regex', 'freshbooks_project_id': 1}]  # book everything
+    with open(os.path.join(directory, 'rules.json'), 'w') as rules_file:
+        json.dump(rules, rules_file)
+
+
+def reset(server):
+    """Removes state of previous benchmark (caches, journals) and points sessions to fake server."""
+    from core import Core
+    for name in os.listdir('.'):
+        if name not in ('config.json', 'rules.json', 'system.log'):
+            os.remove(name)
+    Core.sessions.clear()
+    Core.match_indexes.clear()
+    core = Core()
+    sessions = [core.get_session('toggl'), core.get_session('freshbooks'),
+                core.get_session('zendesk', (core.zen_creds['email'], core.zen_creds['subdomain']))]
+    for session in sessions:
+        session.mount('https://', LocalAdapter(server.url, pool_maxsize=core.pool_size))
+
+
+def bench(name, function, repeat=1):
+    """Runs function (silently) and returns name and best duration in seconds."""
+    durations = []
+    for _ in range(repeat):
+        with contextlib.redirect_stdout(io.StringIO()):
+            started = time.perf_counter()
+            function()
+            durations.append(time.perf_counter() - started)
+    return name, min(durations)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--latency', type=float, default=0.02, help='seconds added to every API call')
+    parser.add_argument('--page-size', type=int, default=100, help='Zendesk results per page')
+    parser.add_argument('--rate-limit', type=int, default=None, help='max API calls per second')
+    parser.add_argument('--projects', type=int, default=10000)
+    parser.add_argument('--clients', type=int, default=500)
+    parser.add_argument('--entries', type=int, default=50000)
+    parser.add_argument('--tickets', type=int, default=1000)
+    parser.add_argument('--days', type=int, default=7, help='days to sync and book')
+    args = parser.parse_args()
+
+    print("Generating fake data...")
+    data = FakeData(args.projects, args.clients, args.entries, args.tickets)
+    server = FakeServer(data, args.latency, args.page_size, args.rate_limit).start()
+    directory = tempfile.mkdtemp(prefix='workautomation-bench-')
+    write_config(directory)
+    os.chdir(directory)
+    reset(server)
+
+    from core import Core
+    from main import Automation
+    results = []
+
+    automation = Automation()
+
+    def run_merge():
+        automation.merge_toggl_time_entries(data.time_entries)
+    results.append(bench('merge_toggl_time_entries (%i entries)' % len(data.time_entries), run_merge, 3))
+
+    names = [project['name'] for project in data.projects]
+    queries = [random.Random(i).choice(FakeData.WORDS) + ' ' + random.Random(-i).choice(FakeData.WORDS)
+               for i in range(20)]
+
+    def run_fuzzy_match():
+        Core.match_indexes.clear()
+        core = Core()
+        for query in queries:
+            core.fuzzy_match(query, names)
+    results.append(bench('fuzzy_match (%i queries, %i choices)' % (len(queries), len(names)), run_fuzzy_match))
+
+    def run_sync():
+        reset(server)
+        if not Automation().sync(args.days):
+            raise RuntimeError("Sync failed, see system.log in %s" % directory)
+    results.append(bench('sync (%i days)' % args.days, run_sync))
+
+    def run_time_tracking():
+        reset(server)
+        Automation().time_tracking(headless=True, days=args.days)
+    results.append(bench('headless time_tracking (%i days)' % args.days, run_time_tracking))
+
+    print("%-50s %10s" % ('benchmark', 'seconds'))
+    for name, duration in results:
+        print("%-50s %10.3f" % (name, duration))
+
+
+if __name__ == '__main__':
+    main()
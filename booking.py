@@ -0,0 +1,162 @@
+from core import Core
+from metrics import metrics
+from concurrent.futures import ThreadPoolExecutor
+import datetime
+import json
+import os
+import threading
+from requests import RequestException
+
+
+class Booking(Core):
+    """Books Toggl entries into FreshBooks in two phases: first plan all entries, then commit them.
+    Every step is written to an append-only journal, so an interrupted run can be resumed
+    without booking anything twice."""
+
+    STATUSES = ('pending', 'booked', 'tagged', 'failed', 'untagged')  # most important first
+
+    def __init__(self, freshbooks, toggl):
+        super(Booking, self).__init__(freshbooks.profile)
+        self.fb = freshbooks
+        self.tg = toggl
+        self.plan = []  # entries to book on commit
+        self.lock = threading.Lock()
+        self.statuses = {}  # Toggl entry id (string) -> status of last journal record with that id
+        self.journal = self.read_journal()  # key -> last journal record
+
+    def get_key(self, toggl_ids):
+        """Returns journal key for a (merged) entry, based on its Toggl entry ids."""
+        return ','.join(str(i) for i in sorted(toggl_ids))
+
+    def read_journal(self):
+        """Reads journal from disk. Returns dictionary with last record for every key
+        (fields of earlier records, like the entry itself, are kept)."""
+        journal = {}
+        try:
+            with open(self.journal_path, 'r') as journal_file:
+                for line in journal_file:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        continue  # half written line, crashed while writing
+                    journal[record['key']] = dict(journal.get(record['key'], {}), **record)  # keep entry
+                    self.set_statuses(record)
+        except IOError:
+            pass
+        return journal
+
+    def write_journal(self, key, status, **fields):
+        """Appends record to journal and makes sure it hits the disk before continuing."""
+        record = dict(fields, key=key, status=status, time=str(datetime.datetime.now()))
+        with self.lock:
+            with open(self.journal_path, 'a') as journal_file:
+                journal_file.write(json.dumps(record) + '\n')
+                journal_file.flush()
+                os.fsync(journal_file.fileno())
+            self.journal[key] = dict(self.journal.get(key, {}), **record)
+            self.set_statuses(record)
+
+    def set_statuses(self, record):
+        """Remembers status of journal record for every Toggl entry id in it."""
+        for toggl_id in record['key'].split(','):
+            self.statuses[toggl_id] = record['status']
+
+    def get_status(self, toggl_ids):
+        """Returns journal status of entry ('pending', 'booked', 'tagged', 'failed', 'untagged') or None.
+        Statuses are kept per Toggl entry id, so a merged entry counts as booked if any of its
+        Toggl entries was booked before (e.g. in a crashed run, merged with other entries)."""
+        statuses = set(self.statuses.get(str(i)) for i in toggl_ids)
+        return next((status for status in self.STATUSES if status in statuses), None)
+
+    def add(self, project_id, duration, description, date, toggl_ids, task_id=2):
+        """Plans entry for booking. Returns False if journal says it was booked before."""
+        if self.get_status(toggl_ids) in ('pending', 'booked', 'tagged'):
+            return False
+        self.plan.append({
+            'project_id': project_id,
+            'task_id': task_id,
+            'duration': duration,
+            'description': description,
+            'date': date,
+            'toggl_ids': list(toggl_ids),
+            })
+        return True
+
+    def book(self, entry):
+        """Adds a single planned entry to FreshBooks. Returns True if successful."""
+        key = self.get_key(entry['toggl_ids'])
+        self.write_journal(key, 'pending', entry=entry)
+        try:
+            self.fb.add_entry(entry['project_id'], entry['duration'], entry['description'],
+                              entry['date'], entry['task_id'])
+        except ValueError:
+            # FreshBooks refused the entry, so it's safe to try again next time
+            self.write_journal(key, 'failed')
+            return False
+        except RequestException as error:
+            # Entry may or may not have made it, it stays 'pending' until resolve_pending looks it up
+            self.log("Couldn't book '%s': %s" % (entry['description'], error), silent=False, level='error')
+            return False
+        self.write_journal(key, 'booked')
+        return True
+
+    def commit(self):
+        """Books all planned entries concurrently, then tags all booked Toggl entries at once.
+        Also finishes entries of earlier runs that were booked but never tagged."""
+        if self.plan:
+            self.print("Booking %i entries..." % len(self.plan))
+            with metrics.span('book'), ThreadPoolExecutor(max_workers=self.workers) as pool:
+                list(pool.map(self.book, self.plan))
+            self.plan = []
+        return self.finish()
+
+    def finish(self):
+        """Resolves pending journal records, then tags Toggl entries of all records that were booked
+        but not tagged yet, at once. Also call it before fetching Toggl entries to book, so entries
+        booked by a crashed run are never merged with new entries. Returns number of records to tag."""
+        self.resolve_pending()
+        unfinished = [record['key'] for record in self.journal.values() if record['status'] == 'booked']
+        if unfinished:
+            # Tag entries of the whole session at once, Toggl takes many IDs per call:
+            toggl_ids = [int(i) for key in unfinished for i in key.split(',')]
+            with metrics.span('tag'):
+                tagged = self.tg.tag_projects(toggl_ids, self.tg.BOOKED_TAG)
+            for key in unfinished:
+                # Entries that couldn't be tagged stay 'booked', so the next run tries again:
+                if all(int(i) in tagged for i in key.split(',')):
+                    self.write_journal(key, 'tagged')
+        return len(unfinished)
+
+    def resolve_pending(self):
+        """Looks up entries of 'pending' records (crashed or lost connection while booking) in FreshBooks.
+        Entries that made it are marked 'booked', so they get tagged, the others 'failed',
+        so they're booked again. Records stay pending if FreshBooks can't be reached."""
+        pending = [record for record in self.journal.values() if record['status'] == 'pending']
+        if not pending:
+            return
+        dates = [record['entry']['date'] for record in pending]
+        fb_entries = {}
+        try:
+            for fb_entry in self.fb.iter_time_entries(min(dates), max(dates)):
+                key = self.get_entry_key(fb_entry['project_id'], fb_entry['date'], fb_entry['hours'],
+                                         fb_entry['notes'])
+                fb_entries[key] = fb_entries.get(key, 0) + 1
+        except RequestException as error:
+            self.log("Couldn't check %i pending entries in FreshBooks: %s" % (len(pending), error),
+                     silent=False, level='error')
+            return
+        for record in pending:
+            entry = record['entry']
+            key = self.get_entry_key(entry['project_id'], entry['date'], entry['duration'], entry['description'])
+            if fb_entries.get(key):
+                fb_entries[key] -= 1  # every FreshBooks entry only resolves a single record
+                self.print("Found pending entry '%s' in FreshBooks." % entry['description'], 'ok')
+                self.write_journal(record['key'], 'booked')
+            else:
+                self.print("Pending entry '%s' isn't in FreshBooks, it will be booked again." % entry['description'],
+                           'warn')
+                self.write_journal(record['key'], 'failed')
+
+    def get_entry_key(self, project_id, date, hours, notes):
+        """Returns key identifying a FreshBooks entry by project, date, hours and (normalized) notes."""
+        return (str(project_id), date, round(float(hours), 2), self.normalize_notes(notes))
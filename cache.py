@@ -0,0 +1,86 @@
+from core import Core
+import json
+import os
+import threading
+import time
+
+
+class Cache(Core):
+    """Persistent on-disk cache for API data that rarely changes (clients, projects)."""
+
+    DEFAULT_TTLS = {
+        'toggl_clients': 60 * 60,
+        'toggl_projects': 15 * 60,
+        'freshbooks_projects': 24 * 60 * 60,
+        }
+    lock = threading.Lock()  # shared by all caches, they write to the same file
+
+    def __init__(self, profile=None):
+        super(Cache, self).__init__(profile)
+        self.entries = self.load()
+
+    def load(self):
+        """Reads cache file from disk. Returns dictionary of cache entries."""
+        self.loaded_version = self.get_version()
+        try:
+            with open(self.cache_path, 'r') as cache_file:
+                return json.load(cache_file)
+        except (IOError, ValueError):
+            return {}
+
+    def save(self):
+        """Writes cache entries to disk. Replaces file atomically so a crash can't corrupt it."""
+        tmp_path = self.cache_path + '.tmp'
+        with open(tmp_path, 'w') as cache_file:
+            json.dump(self.entries, cache_file)
+        os.replace(tmp_path, self.cache_path)
+        self.loaded_version = self.get_version()
+
+    def get_version(self):
+        """Returns modification time of cache file (in nanoseconds), None if there is no file.
+        Tells whether another cache or process wrote the file since this cache read or wrote it."""
+        try:
+            return os.stat(self.cache_path).st_mtime_ns
+        except OSError:
+            return None
+
+    def get_ttl(self, key):
+        """Returns time to live in seconds for key, can be overridden with 'cache_ttl' in config."""
+        return self.cache_ttls.get(key, self.DEFAULT_TTLS.get(key, 0))
+
+    def get(self, key):
+        """Returns cached value for key, or None if missing, expired or invalidated."""
+        entry = self.entries.get(key)
+        if not entry or entry.get('invalid'):
+            return None
+        if time.time() - entry['fetched_at'] > self.get_ttl(key):
+            return None
+        return entry['value']
+
+    def get_entry(self, key):
+        """Returns tuple of cached value and fetch time (unix timestamp), even if expired.
+        Useful for incremental refreshes. Returns (None, 0) if key is missing."""
+        entry = self.entries.get(key)
+        if not entry:
+            return None, 0
+        return entry['value'], entry['fetched_at']
+
+    def set(self, key, value, fetched_at=None):
+        """Stores value under key and persists cache to disk."""
+        with self.lock:
+            self.entries = self.load()  # keep entries other caches wrote in the meantime
+            self.entries[key] = {
+                'value': value,
+                'fetched_at': fetched_at if fetched_at else time.time()
+                }
+            self.save()
+
+    def invalidate(self, key):
+        """Marks cached value for key as expired, so next lookup refreshes it."""
+        with self.lock:
+            if self.entries.get(key, {}).get('invalid') and self.get_version() == self.loaded_version:
+                return  # already invalid on disk too, e.g. when creating many projects in a row
+            self.entries = self.load()  # another cache or process may have refreshed it in the meantime
+            if key in self.entries and not self.entries[key].get('invalid'):
+                self.entries[key]['invalid'] = True
+                self.save()
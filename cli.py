@@ -0,0 +1,152 @@
+# Single entry point for all commands, e.g. 'python cli.py sync 3' or 'python cli.py track --headless'
+# Commands import what they need themselves, so starting one (e.g. from cron) stays fast.
+import argparse
+import datetime
+import sys
+
+
+def run_profiles(args, **kwargs):
+    """Runs command for the profiles given by --profile or --all-profiles. Returns True if all succeeded."""
+    from profiles import ProfileRunner
+    summaries = ProfileRunner(args.profile).run(**kwargs)
+    return all(summary['status'] == 'ok' for summary in summaries)
+
+
+def sync(args):
+    """Creates Toggl projects based on Zendesk tickets."""
+    if args.profile or args.all_profiles:
+        return run_profiles(args, sync_days=args.days, incremental=args.incremental)
+    from main import Automation
+    if args.daemon:
+        from daemon import Daemon
+        Daemon(Automation()).run()
+        return True
+    return Automation().sync(args.days, args.incremental)
+
+
+def track(args):
+    """Starts time tracking in FreshBooks based on Toggl entries."""
+    if args.profile or args.all_profiles:
+        return run_profiles(args, booking_days=args.days or 1)
+    from main import Automation
+    days = args.days if args.days or not args.headless else 1
+    Automation().time_tracking(args.headless, days, args.end_date)
+    return True
+
+
+def warm_cache(args):
+    """Loads clients and projects into the cache."""
+    from main import Automation
+    return all(Automation(name).warm_cache() for name in get_profile_names(args))
+
+
+def status(args):
+    """Prints cache, sync and booking state."""
+    from main import Automation
+    for name in get_profile_names(args):
+        Automation(name).print_status()
+    return True
+
+
+def mirror(args):
+    """Updates local mirror of Toggl, FreshBooks and Zendesk data."""
+    from main import Automation
+    from mirror import Mirror
+    for name in get_profile_names(args):
+        Mirror(name).update(Automation(name), args.days)
+    return True
+
+
+def report(args):
+    """Prints unbooked entries and tickets without project, from the local mirror."""
+    from mirror import Mirror
+    for name in get_profile_names(args):
+        Mirror(name).print_report(args.days)
+    return True
+
+
+def reconcile(args):
+    """Finds (and fixes) differences between FreshBooks entries and Toggl booked tags."""
+    from main import Automation
+    from reconcile import Reconciler
+    for name in get_profile_names(args):
+        Reconciler(Automation(name)).run(args.days, args.end_date, args.fix)
+    return True
+
+
+def get_profile_names(args):
+    """Returns profile names to run a command for, [None] for the general settings."""
+    if args.all_profiles:
+        from core import Core
+        return sorted(Core().profiles)
+    return args.profile or [None]
+
+
+def get_parser():
+    """Returns argument parser with a sub parser for every command."""
+    parser = argparse.ArgumentParser(description="Automates Zendesk, Toggl and FreshBooks chores.")
+    profiles = argparse.ArgumentParser(add_help=False)  # options shared by all commands
+    profiles.add_argument('--profile', action='append', help="run for profile from config (can be repeated)")
+    profiles.add_argument('--all-profiles', action='store_true', help="run for all profiles from config")
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    sync_parser = commands.add_parser('sync', parents=[profiles], help=sync.__doc__)
+    sync_parser.add_argument('days', type=int, nargs='?', default=1, help="number of days to sync")
+    sync_parser.add_argument('--incremental', action='store_true',
+                             help="only sync tickets changed since last run")
+    sync_parser.add_argument('--daemon', action='store_true', help="keep running and sync every few minutes")
+    sync_parser.set_defaults(function=sync)
+
+    track_parser = commands.add_parser('track', parents=[profiles], help=track.__doc__)
+    track_parser.add_argument('days', type=int, nargs='?', default=None, help="number of days to go back")
+    track_parser.add_argument('end_date', type=datetime.date.fromisoformat, nargs='?', default=None,
+                              help="last day to book, e.g. 2018-03-31")
+    track_parser.add_argument('--headless', action='store_true', help="book according to rules without prompting")
+    track_parser.set_defaults(function=track)
+
+    warm_parser = commands.add_parser('warm-cache', parents=[profiles], help=warm_cache.__doc__)
+    warm_parser.set_defaults(function=warm_cache)
+
+    status_parser = commands.add_parser('status', parents=[profiles], help=status.__doc__)
+    status_parser.set_defaults(function=status)
+
+    mirror_parser = commands.add_parser('mirror', parents=[profiles], help=mirror.__doc__)
+    mirror_parser.add_argument('--days', type=int, default=None, help="days to load on the first run")
+    mirror_parser.set_defaults(function=mirror)
+
+    report_parser = commands.add_parser('report', parents=[profiles], help=report.__doc__)
+    report_parser.add_argument('--days', type=int, default=30, help="number of days to report on")
+    report_parser.set_defaults(function=report)
+
+    reconcile_parser = commands.add_parser('reconcile', parents=[profiles], help=reconcile.__doc__)
+    reconcile_parser.add_argument('days', type=int, nargs='?', default=7, help="number of days to go back")
+    reconcile_parser.add_argument('end_date', type=datetime.date.fromisoformat, nargs='?', default=None,
+                                  help="last day to reconcile, e.g. 2018-03-31")
+    reconcile_parser.add_argument('--fix', action='store_true',
+                                  help="tag, untag and delete duplicates instead of only reporting")
+    reconcile_parser.set_defaults(function=reconcile)
+    return parser
+
+
+def convert_profiles(argv):
+    """Converts '--profiles' options of the old sync.py and timetracking.py scripts to the new options."""
+    converted = []
+    for arg in argv:
+        if arg == '--profiles':
+            converted.append('--all-profiles')
+        elif arg.startswith('--profiles='):
+            for name in arg.partition('=')[2].split(','):
+                converted += ['--profile', name]
+        else:
+            converted.append(arg)
+    return converted
+
+
+def main(argv=None):
+    """Runs command from command line arguments. Returns exit code."""
+    args = get_parser().parse_args(argv)
+    return 0 if args.function(args) else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
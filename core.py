@@ -1,19 +1,43 @@
 import json
-import datetime
-from fuzzywuzzy import process, fuzz
+import os
+import threading
+from logs import get_logger
+from metrics import metrics
 import unicodedata
+import logging
+import random
+import re
 
 
 class Core():
     """Contains shared core operations."""
 
-    def __init__(self):
-        """Initializes object and parses config."""
-        self.parse_config()
+    sessions = {}  # pooled keep-alive sessions, shared by all objects (one per service)
+    sessions_lock = threading.Lock()
+    match_indexes = {}  # fuzzy match indexes, shared by all objects (one per choice set)
+    shared = None  # data shared between profiles during a multi-profile run, see ProfileRunner
+    configs = {}  # parsed config files, every file is only read once per process
+
+    def __init__(self, profile=None):
+        """Initializes object and parses config (of profile, if specified)."""
+        self.parse_config(profile=profile)
+
+    def parse_config(self, config_path="config.json", profile=None):
+        """Parses config and sets config variables.
+        Settings of a profile (see 'profiles' in config) override the general settings,
+        and files with state (cache, journal, etc.) get a separate copy per profile."""
+        config = dict(self.load_config(config_path))
+        self.profile = profile
+        overrides = config.get('profiles', {})[profile] if profile else {}
+        config.update(overrides)
+
+        def get_path(key, default):
+            path = config.get(key, default)
+            if profile and key not in overrides:
+                directory, filename = os.path.split(path)
+                path = os.path.join(directory, '%s.%s' % (profile, filename))
+            return path
 
-    def parse_config(self, config_path="config.json"):
-        """Parses config and sets config variables."""
-        config = json.load(open(config_path, 'r'))
         self.zen_creds = {
             'email' : config.get('zendesk_email'),
             'token' : config.get('zendesk_token'),
@@ -26,14 +50,94 @@ class Core():
             'token': config.get('freshbooks_token'),
             'subdomain': config.get('freshbooks_subdomain')
             }
+        self.pool_size = config.get('pool_size', 10)
+        self.workers = config.get('workers', 4)
+        self.batch_size = config.get('batch_size', 100)
+        self.time_entry_window = config.get('time_entry_window', 7)  # days per Toggl time entries request
+        self.async_limits = config.get('async_limits', {})  # max concurrent calls per service
+        self.cache_path = get_path('cache_path', 'cache.json')
+        self.cache_ttls = config.get('cache_ttl', {})
+        self.journal_path = get_path('journal_path', 'booking.journal')
+        self.rules_path = get_path('rules_path', 'rules.json')
+        self.zendesk_mark_path = get_path('zendesk_mark_path', 'zendesk_mark.json')
+        self.mirror_path = get_path('mirror_path', 'mirror.db')
+        self.decisions_path = get_path('decisions_path', 'decisions.json')
+        self.mirror_settings = config.get('mirror', {})
+        self.daemon = config.get('daemon', {})
+        self.log_settings = config.get('log', {})
+        self.metrics_settings = config.get('metrics', {})
+        self.rate_limits = config.get('rate_limits', {})
+        self.profiles = config.get('profiles', {})
+
+    def load_config(self, config_path="config.json"):
+        """Returns parsed config file, reads it on first use only."""
+        config = Core.configs.get(config_path)
+        if config is None:
+            with open(config_path, 'r') as config_file:
+                config = json.load(config_file)
+            Core.configs[config_path] = config
+        return config
+
+    def get_shared(self, key, loader):
+        """Returns data shared with the other profiles of a multi-profile run, loads it once
+        with loader if no profile did yet. Outside of such a run, simply returns loader()."""
+        if Core.shared is None:
+            return loader()
+        return Core.shared.get_or_load(key, loader)
+
+    def get_session(self, service, identity=None):
+        """Returns pooled keep-alive HTTP session for service (e.g. 'toggl').
+        Session is created on first use and shared afterwards, so connections get reused.
+        Specify identity for services whose client stores credentials in the session.
+        Every call goes through the rate limit governor, see governor.py."""
+        with Core.sessions_lock:
+            session = Core.sessions.get((service, identity))
+            if session is None:
+                from governor import governor, GovernedSession  # imports requests, only load it when needed
+                from requests.adapters import HTTPAdapter
+                governor.configure(self.rate_limits)
+                session = GovernedSession(service, governor, self.rate_limits.get('max_retries', 5))
+                adapter = HTTPAdapter(pool_connections=self.pool_size, pool_maxsize=self.pool_size)
+                session.mount('https://', adapter)
+                session.mount('http://', adapter)
+                session.headers.update({
+                    'Accept-Encoding': 'gzip, deflate',
+                    'Connection': 'keep-alive',
+                    })
+                session.hooks['response'].append(metrics.get_hook(service))  # record every call
+                Core.sessions[(service, identity)] = session
+        return session
 
-    def log(self, entry, silent=True):
-        """Logs entries to system.log, also prints if not silent."""
+    def log(self, entry, silent=True, level='info', **fields):
+        """Logs entries to system.log, also prints if not silent.
+        Optional fields (service, endpoint, entity_id, duration) end up in JSON log lines."""
         entry = str(entry).strip()
         if not silent:
             print(entry)
-        with open('system.log', 'a') as log:
-            log.write(str(datetime.datetime.now()) + ' ' + entry + '\n')
+        get_logger(self.log_settings).log(getattr(logging, level.upper()), entry, extra=fields)
+
+    def log_response(self, body, silent=True, **fields):
+        """Logs API response body. Full bodies are only logged at debug level,
+        otherwise they are sampled and truncated (see 'log' in config)."""
+        body = str(body).strip()
+        if not silent:
+            print(body)
+        logger = get_logger(self.log_settings)
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug(body, extra=fields)
+        elif random.random() < self.log_settings.get('body_sample_rate', 1.0):
+            limit = self.log_settings.get('body_limit', 1000)
+            if len(body) > limit:
+                body = body[:limit] + '... (%i characters truncated)' % (len(body) - limit)
+            logger.info(body, extra=fields)
+
+    def report_metrics(self):
+        """Logs summary of API calls and phases (prints it too if enabled in config).
+        Also writes Prometheus textfile if a path is configured."""
+        for line in metrics.get_summary():
+            self.log(line, silent=not self.metrics_settings.get('summary', False))
+        if self.metrics_settings.get('textfile'):
+            metrics.write_textfile(self.metrics_settings['textfile'])
 
     def print(self, string, format=None):
         """Prints string according to different formats."""
@@ -77,15 +181,28 @@ class Core():
         """
         print(splash)
 
+    def get_match_index(self, choices):
+        """Returns fuzzy match index for list of choices, builds it if the choices are new."""
+        choices = tuple(choices)
+        index = Core.match_indexes.get(choices)
+        if index is None:
+            from matching import MatchIndex  # imports fuzzywuzzy, only load it when needed
+            if len(Core.match_indexes) >= 10:
+                Core.match_indexes.clear()  # choice sets changed a lot, start over
+            index = MatchIndex(choices)
+            Core.match_indexes[choices] = index
+        return index
+
     def fuzzy_match(self, query, choices, cutoff=0):
         """Returns best approximate match in a list of strings by fuzzy matching.
            Set cutoff score to specify accuracy (value between 0-100).
            Returns None if results are too inaccurate."""
-        results = process.extract(query, choices)
-        if results[0][1] < cutoff:
+        results = self.get_match_index(choices).extract(query)
+        if not results or results[0][1] < cutoff:
             return None
-        if results[0][1] == results[1][1]:
+        if len(results) > 1 and results[0][1] == results[1][1]:
             # Use token set ratio on best results as a tie breaker
+            from fuzzywuzzy import process, fuzz
             best_results = [r[0] for r in results[:15]]
             results = process.extract(query, best_results, scorer=fuzz.token_set_ratio)
         best_match = results[0][0]
@@ -95,3 +212,7 @@ class Core():
         """Normalizes special characters in string because the FreshBooks API never heard of utf-8."""
         string = unicodedata.normalize('NFKD', string)
         return string.encode('ASCII', 'ignore').decode('utf-8')
+
+    def normalize_notes(self, notes):
+        """Returns (FreshBooks) notes without special characters, extra whitespace and capitals."""
+        return re.sub(r'\s+', ' ', self.normalize_string(notes or '')).strip().lower()
@@ -0,0 +1,72 @@
+from core import Core
+import datetime
+import json
+import os
+import random
+import threading
+import time
+import traceback
+
+
+class Daemon(Core):
+    """Runs incremental syncs on an interval in a single long running process.
+    Service clients and caches stay in memory between runs and are refreshed in the background."""
+
+    def __init__(self, automation):
+        super(Daemon, self).__init__(automation.profile)
+        self.automation = automation
+        self.interval = self.daemon.get('interval', 300)  # seconds between syncs
+        self.jitter = self.daemon.get('jitter', 30)  # max random extra seconds between syncs
+        self.refresh_interval = self.daemon.get('refresh_interval', 900)  # seconds between metadata refreshes
+        self.status_path = self.daemon.get('status_path', 'daemon_status.json')
+        self.lock = threading.Lock()
+        self.status = {
+            'pid': os.getpid(),
+            'started': str(datetime.datetime.now()),
+            'syncs': 0,
+            'failed_syncs': 0,
+            'last_sync': None,
+            'last_sync_duration': None,
+            'last_refresh': None,
+            'next_sync': None,
+            }
+
+    def write_status(self, **fields):
+        """Updates status file, which can be checked to see if the daemon is healthy."""
+        with self.lock:
+            self.status.update(fields)
+            self.status['updated'] = str(datetime.datetime.now())
+            tmp_path = self.status_path + '.tmp'
+            with open(tmp_path, 'w') as status_file:
+                json.dump(self.status, status_file, indent=4)
+            os.replace(tmp_path, self.status_path)
+
+    def refresh(self):
+        """Keeps refreshing Toggl clients and projects in the background."""
+        while True:
+            time.sleep(self.refresh_interval)
+            try:
+                self.automation.get_service('toggl').refresh()
+                self.write_status(last_refresh=str(datetime.datetime.now()))
+            except:
+                self.log(traceback.format_exc(), silent=False, level='error')
+
+    def run(self):
+        """Starts syncing every interval (plus some jitter) until interrupted."""
+        self.print("Starting sync daemon, syncing every %i seconds..." % self.interval)
+        threading.Thread(target=self.refresh, daemon=True).start()
+        try:
+            while True:
+                started = time.time()
+                succeeded = self.automation.sync(incremental=True)
+                delay = self.interval + random.uniform(0, self.jitter)
+                self.write_status(
+                    syncs=self.status['syncs'] + 1,
+                    failed_syncs=self.status['failed_syncs'] + (0 if succeeded else 1),
+                    last_sync=str(datetime.datetime.now()),
+                    last_sync_duration=round(time.time() - started, 3),
+                    next_sync=str(datetime.datetime.now() + datetime.timedelta(seconds=delay)),
+                    )
+                time.sleep(delay)
+        except KeyboardInterrupt:
+            self.print("Ok, stopping sync daemon.", 'cross')
@@ -0,0 +1,95 @@
+from core import Core
+import json
+import os
+import threading
+import time
+
+
+class Decisions(Core):
+    """Remembers which FreshBooks project the user picked for a Toggl client and project,
+    so the same choice doesn't have to be made (and fuzzy matched) every day."""
+
+    MAX_DECISIONS = 1000  # least recently used decisions are forgotten first
+
+    def __init__(self, profile=None):
+        super(Decisions, self).__init__(profile)
+        self.lock = threading.Lock()
+        self.decisions = self.load()
+        self.changed = False
+
+    def load(self):
+        """Reads decisions file. Returns dictionary with decision for every key."""
+        try:
+            with open(self.decisions_path, 'r') as decisions_file:
+                return json.load(decisions_file)
+        except (IOError, ValueError):
+            return {}
+
+    def save(self):
+        """Writes decisions to disk if they changed. Replaces file atomically."""
+        with self.lock:
+            if not self.changed:
+                return
+            tmp_path = self.decisions_path + '.tmp'
+            with open(tmp_path, 'w') as decisions_file:
+                json.dump(self.decisions, decisions_file, indent=4)
+            os.replace(tmp_path, self.decisions_path)
+            self.changed = False
+
+    def get_keys(self, client_name, project_name):
+        """Returns keys to look up, most specific first: client and project, then client only."""
+        keys = ['%s\t%s' % (client_name or '', project_name or '')]
+        if client_name:
+            keys.append('%s\t' % client_name)
+        return keys
+
+    def resolve(self, client_name, project_name, fb_projects):
+        """Returns remembered FreshBooks project name for Toggl client and project, or None.
+        Only decisions for this very project count, see suggest for other projects of the client.
+        Accepts dictionary of current FreshBooks projects (name-id), decisions for projects
+        that no longer exist are forgotten."""
+        with self.lock:
+            decision = self.get_decision(self.get_keys(client_name, project_name)[0], fb_projects)
+            if not decision:
+                return None
+            decision['hits'] += 1
+            decision['last_used'] = time.time()
+            self.changed = True
+            return decision['freshbooks_project']
+
+    def suggest(self, client_name, fb_projects):
+        """Returns FreshBooks project name picked most recently for any project of Toggl client, or None.
+        Only a suggestion, the user still has to confirm it."""
+        if not client_name:
+            return None
+        with self.lock:
+            decision = self.get_decision(self.get_keys(client_name, None)[-1], fb_projects)
+            return decision['freshbooks_project'] if decision else None
+
+    def get_decision(self, key, fb_projects):
+        """Returns decision for key, or None. Forgets it if its FreshBooks project no longer exists."""
+        decision = self.decisions.get(key)
+        if decision and decision['freshbooks_project'] not in fb_projects:
+            del self.decisions[key]  # project is gone, ask again
+            self.changed = True
+            return None
+        return decision
+
+    def remember(self, client_name, project_name, fb_project_name):
+        """Remembers FreshBooks project the user confirmed for Toggl client and project.
+        The most recent choice for a client is also suggested for its other projects."""
+        now = time.time()
+        with self.lock:
+            for key in self.get_keys(client_name, project_name):
+                decision = self.decisions.get(key)
+                if decision and decision['freshbooks_project'] == fb_project_name:
+                    decision['hits'] += 1
+                    decision['last_used'] = now
+                else:
+                    self.decisions[key] = {'freshbooks_project': fb_project_name, 'hits': 1,
+                                           'last_used': now, 'created': now}
+            if len(self.decisions) > self.MAX_DECISIONS:
+                by_recency = sorted(self.decisions, key=lambda key: self.decisions[key]['last_used'])
+                for key in by_recency[:len(self.decisions) - self.MAX_DECISIONS]:
+                    del self.decisions[key]
+            self.changed = True
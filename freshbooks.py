@@ -1,14 +1,19 @@
 from core import Core
+from cache import Cache
 from xml.dom import minidom
-import requests
+from xml.etree import ElementTree
+from concurrent.futures import ThreadPoolExecutor
+import io
 import json
 
 
 class FreshBooks(Core):
     """Contains all Freshbooks related operations."""
 
-    def __init__(self):
-        super(FreshBooks, self).__init__()
+    def __init__(self, profile=None):
+        super(FreshBooks, self).__init__(profile)
+        self.session = self.get_session('freshbooks')
+        self.cache = Cache(profile)  # persistent cache for projects
         self.projects = None
 
     def add_entry(self, project_id, duration, description, date, task_id=2):
@@ -27,16 +32,18 @@ class FreshBooks(Core):
         </request>
         """ % (str(project_id), str(task_id), str(duration), description, date)
         url = 'https://' + self.fb_creds['subdomain'] + '.freshbooks.com/api/2.1/xml-in'
-        response = requests.post(url, data=xml_request, auth=(self.fb_creds['token'], 'X'))
+        response = self.session.post(url, data=xml_request, auth=(self.fb_creds['token'], 'X'))
         xml = minidom.parseString(response.text)
         elements = xml.getElementsByTagName('response')
         status = elements[0].attributes['status'].value
         if status == 'ok':
             self.print("Entry added to Freshbooks.", 'ok')
-            self.log(response.text, silent=True)
+            self.log_response(response.text, service='freshbooks', endpoint='time_entry.create',
+                              entity_id=project_id)
         else:
             self.print("Whoops something went wrong on Freshbooks end!", 'cross')
-            self.log(response.text, silent=False)
+            self.log(response.text, silent=False, level='error', service='freshbooks',
+                     endpoint='time_entry.create', entity_id=project_id)
             raise ValueError("Unexpected response from Freshbooks!"
                              "Incident has been logged.")
         return response.text
@@ -50,28 +57,134 @@ class FreshBooks(Core):
         # Additional note: their API is really shitty.
         if self.projects:
             return self.projects
-        print("Loading Freshbooks projects from their shitty XML API...")
-        result = {}
-        projects = ['project']
-        i = 1
-        while len(projects) != 0:
-            xml_request = """
-            <?xml version="1.0" encoding="utf-8"?>
-            <request method="project.list">     <!-- Hey Freshbooks, -->
-              <page>%i</page>                   <!-- your API sucks! -->
-              <per_page>100</per_page>          <!-- Ever heard of JSON? -->
-            </request>
-            """ % (i)
-            i += 1
-            url = 'https://' + self.fb_creds['subdomain'] + '.freshbooks.com/api/2.1/xml-in'
-            response = requests.post(url, data=xml_request, auth=(self.fb_creds['token'], 'X'))
-            xmldoc = minidom.parseString(response.text)
-            projects = xmldoc.getElementsByTagName('project')
-            if len(projects):
-                for project in projects:
-                    name = project.getElementsByTagName("name")[0].firstChild.nodeValue
-                    project_id = project.getElementsByTagName("project_id")[0].firstChild.nodeValue
-                    result[name] = project_id
+        projects = self.cache.get('freshbooks_projects')
+        if projects is not None:
+            self.projects = projects
+            return projects
+        # Profiles with the same FreshBooks account only load projects once:
+        key = ('freshbooks_projects', self.fb_creds['subdomain'])
+        result = self.get_shared(key, self.load_projects)
         # Did I mention their API is really shitty?
         self.projects = result
+        self.cache.set('freshbooks_projects', result)
         return result
+
+    def refresh(self):
+        """Reloads projects from the API and updates the cache. Returns projects."""
+        self.projects = None
+        self.cache.invalidate('freshbooks_projects')
+        return self.get_projects()
+
+    def load_projects(self):
+        """Loads dictionary of all Freshbooks projects from the API."""
+        print("Loading Freshbooks projects from their shitty XML API...")
+        return dict(self.iter_projects())
+
+    def iter_projects(self, per_page=100):
+        """Generator yielding (name, id) tuples of all Freshbooks projects straight from the API."""
+        return self.iter_pages(lambda page: self.get_projects_page(page, per_page))
+
+    def iter_pages(self, get_page):
+        """Generator yielding items of all pages of a list method. Accepts function returning
+        tuple of total number of pages and list of items for a page number.
+        Reads number of pages from the first page and fetches the other pages concurrently."""
+        pages, items = get_page(1)
+        for item in items:
+            yield item
+        if pages > 1:
+            with ThreadPoolExecutor(max_workers=self.workers) as pool:
+                for items in pool.map(lambda page: get_page(page)[1], range(2, pages + 1)):
+                    for item in items:
+                        yield item
+
+    def get_projects_page(self, page, per_page=100):
+        """Fetches a single page of Freshbooks projects.
+        Returns tuple of total number of pages and list of (name, id) tuples."""
+        xml_request = """
+        <?xml version="1.0" encoding="utf-8"?>
+        <request method="project.list">     <!-- Hey Freshbooks, -->
+          <page>%i</page>                   <!-- your API sucks! -->
+          <per_page>%i</per_page>           <!-- Ever heard of JSON? -->
+        </request>
+        """ % (page, per_page)
+        url = 'https://' + self.fb_creds['subdomain'] + '.freshbooks.com/api/2.1/xml-in'
+        response = self.session.post(url, data=xml_request, auth=(self.fb_creds['token'], 'X'))
+        return self.parse_projects(response.content)
+
+    def parse_projects(self, content):
+        """Parses project.list response, only picks up name and id of every project.
+        Returns tuple of total number of pages and list of (name, id) tuples."""
+        pages = 0
+        projects = []
+        for event, element in ElementTree.iterparse(io.BytesIO(content), events=('start', 'end')):
+            tag = element.tag.rsplit('}', 1)[-1]  # strip namespace
+            if event == 'start' and tag == 'projects':
+                pages = int(element.get('pages', 0))
+            elif event == 'end' and tag == 'project':
+                name = project_id = None
+                for child in element:
+                    child_tag = child.tag.rsplit('}', 1)[-1]
+                    if child_tag == 'name':
+                        name = child.text
+                    elif child_tag == 'project_id':
+                        project_id = child.text
+                projects.append((name, project_id))
+                element.clear()  # free memory of parsed project
+        return pages, projects
+
+    def iter_time_entries(self, date_from, date_to, per_page=100):
+        """Generator yielding all Freshbooks time entries between two dates ('YYYY-MM-DD', inclusive)
+        as dictionaries with time_entry_id, project_id, task_id, hours, date and notes."""
+        return self.iter_pages(lambda page: self.get_time_entries_page(page, per_page, date_from, date_to))
+
+    def get_time_entries_page(self, page, per_page, date_from, date_to):
+        """Fetches a single page of Freshbooks time entries.
+        Returns tuple of total number of pages and list of time entries."""
+        xml_request = """
+        <?xml version="1.0" encoding="utf-8"?>
+        <request method="time_entry.list">
+          <date_from>%s</date_from>
+          <date_to>%s</date_to>
+          <page>%i</page>
+          <per_page>%i</per_page>
+        </request>
+        """ % (date_from, date_to, page, per_page)
+        url = 'https://' + self.fb_creds['subdomain'] + '.freshbooks.com/api/2.1/xml-in'
+        response = self.session.post(url, data=xml_request, auth=(self.fb_creds['token'], 'X'))
+        return self.parse_time_entries(response.content)
+
+    def parse_time_entries(self, content):
+        """Parses time_entry.list response. Returns tuple of total number of pages and list of time entries."""
+        fields = ('time_entry_id', 'project_id', 'task_id', 'hours', 'date', 'notes')
+        pages = 0
+        time_entries = []
+        for event, element in ElementTree.iterparse(io.BytesIO(content), events=('start', 'end')):
+            tag = element.tag.rsplit('}', 1)[-1]  # strip namespace
+            if event == 'start' and tag == 'time_entries':
+                pages = int(element.get('pages', 0))
+            elif event == 'end' and tag == 'time_entry':
+                time_entry = dict.fromkeys(fields)
+                for child in element:
+                    child_tag = child.tag.rsplit('}', 1)[-1]
+                    if child_tag in time_entry:
+                        time_entry[child_tag] = child.text
+                time_entries.append(time_entry)
+                element.clear()  # free memory of parsed time entry
+        return pages, time_entries
+
+    def delete_entry(self, time_entry_id):
+        """Deletes Freshbooks time entry. Raises ValueError if Freshbooks refuses."""
+        xml_request = """
+        <?xml version="1.0" encoding="utf-8"?>
+        <request method="time_entry.delete">
+          <time_entry_id>%s</time_entry_id>
+        </request>
+        """ % str(time_entry_id)
+        url = 'https://' + self.fb_creds['subdomain'] + '.freshbooks.com/api/2.1/xml-in'
+        response = self.session.post(url, data=xml_request, auth=(self.fb_creds['token'], 'X'))
+        if 'status="ok"' not in response.text:
+            self.log(response.text, silent=False, level='error', service='freshbooks',
+                     endpoint='time_entry.delete', entity_id=time_entry_id)
+            raise ValueError("Unexpected response from Freshbooks!")
+        self.log_response(response.text, service='freshbooks', endpoint='time_entry.delete',
+                          entity_id=time_entry_id)
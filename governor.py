@@ -0,0 +1,163 @@
+from contextlib import contextmanager
+from email.utils import parsedate_to_datetime
+from metrics import metrics
+import datetime
+import random
+import requests
+import threading
+import time
+
+
+class TokenBucket():
+    """Allows calls at a steady rate (calls per second) with bursts of up to burst calls.
+    The rate adapts: it's halved when the API throttles and slowly recovers afterwards."""
+
+    MIN_RATE = 0.1  # never go slower than a call every 10 seconds
+    RECOVERY = 1.05  # rate multiplier after every successful call
+
+    def __init__(self, rate=None, burst=1):
+        self.max_rate = rate  # configured rate, None for unlimited
+        self.rate = rate  # current rate, None as long as the API didn't complain
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self.paused_until = 0  # set when the API asks to retry after a while
+        self.calls = []  # monotonic times of calls in the last second
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        """Waits until a call is allowed. Returns number of seconds waited."""
+        waited = 0
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                if now >= self.paused_until:
+                    if self.rate is not None:
+                        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+                    self.updated = now
+                    if self.rate is None or self.tokens >= 1:
+                        if self.rate is not None:
+                            self.tokens -= 1
+                        self.calls = [t for t in self.calls if now - t < 1] + [now]
+                        return waited
+                    delay = (1 - self.tokens) / self.rate
+                else:
+                    delay = self.paused_until - now
+            time.sleep(delay)
+            waited += delay
+
+    def throttle(self, delay):
+        """Pauses calls for delay seconds and halves the rate."""
+        with self.lock:
+            now = time.monotonic()
+            self.paused_until = max(self.paused_until, now + delay)
+            rate = self.rate or len([t for t in self.calls if now - t < 1]) or 1
+            self.rate = max(rate / 2.0, self.MIN_RATE)
+            self.tokens = 0
+
+    def recover(self):
+        """Speeds up again after a successful call, up to the configured rate."""
+        with self.lock:
+            if self.rate is not None and self.rate != self.max_rate:
+                self.rate *= self.RECOVERY
+                if self.max_rate is not None:
+                    self.rate = min(self.rate, self.max_rate)
+
+
+class Governor():
+    """Keeps calls to all services within their rate limits (one token bucket per service
+    and credentials) and caps the number of calls in flight over all services."""
+
+    DEFAULT_LIMITS = {
+        'toggl': {'rate': 1, 'burst': 5},  # roughly a call per second per token
+        'zendesk': {'rate': 10, 'burst': 20},  # 700 calls per minute on most plans
+        'freshbooks': {'rate': None},  # not documented, only adapts when throttled
+        }
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.limits = {}
+        self.buckets = {}  # (service, identity) -> TokenBucket
+        self.semaphore = None
+
+    def configure(self, settings):
+        """Applies 'rate_limits' settings from config, only the first configuration counts."""
+        with self.lock:
+            if self.semaphore is None:
+                self.limits = dict(self.DEFAULT_LIMITS, **settings.get('services', {}))
+                self.backoff = settings.get('backoff', 1.0)
+                self.semaphore = threading.BoundedSemaphore(settings.get('max_concurrency', 16))
+
+    def get_bucket(self, service, identity=None):
+        """Returns token bucket for service and credentials, creates it on first use."""
+        with self.lock:
+            bucket = self.buckets.get((service, identity))
+            if bucket is None:
+                limits = self.limits.get(service, {})
+                bucket = TokenBucket(limits.get('rate'), limits.get('burst', 1))
+                self.buckets[(service, identity)] = bucket
+            return bucket
+
+    @contextmanager
+    def slot(self, service, identity=None):
+        """Context manager waiting for the rate limit of service and a free concurrency slot."""
+        waited = self.get_bucket(service, identity).acquire()
+        started = time.time()
+        with self.semaphore:
+            metrics.record_wait(service, waited + time.time() - started)
+            yield
+
+    def throttle(self, service, identity, response, attempt):
+        """Slows down service after it responded with 429 (or 503). Returns delay in seconds,
+        taken from the Retry-After header if there is one, otherwise exponential backoff."""
+        delay = self.get_retry_after(response)
+        if delay is None:
+            delay = self.backoff * 2 ** attempt * random.uniform(1, 1.5)
+        self.get_bucket(service, identity).throttle(delay)
+        metrics.record_throttle(service)
+        return delay
+
+    def get_retry_after(self, response):
+        """Returns seconds to wait according to Retry-After header (seconds or HTTP date), or None."""
+        value = response.headers.get('Retry-After')
+        if not value:
+            return None
+        try:
+            return max(float(value), 0)
+        except ValueError:
+            pass
+        try:
+            retry_at = parsedate_to_datetime(value)
+            return max((retry_at - datetime.datetime.now(datetime.timezone.utc)).total_seconds(), 0)
+        except (TypeError, ValueError):
+            return None
+
+
+class GovernedSession(requests.Session):
+    """HTTP session sending every call through the governor. Throttled calls are retried,
+    other error responses raise HTTPError."""
+
+    THROTTLED = (429, 503)
+
+    def __init__(self, service, governor, max_retries=5):
+        super(GovernedSession, self).__init__()
+        self.service = service
+        self.governor = governor
+        self.max_retries = max_retries
+
+    def request(self, method, url, *args, **kwargs):
+        auth = kwargs.get('auth') or self.auth
+        identity = auth[0] if isinstance(auth, tuple) else None  # rate limits are per token
+        for attempt in range(self.max_retries + 1):
+            with self.governor.slot(self.service, identity):
+                response = super(GovernedSession, self).request(method, url, *args, **kwargs)
+            if response.status_code not in self.THROTTLED or attempt == self.max_retries:
+                break
+            self.governor.throttle(self.service, identity, response, attempt)
+        if response.status_code not in self.THROTTLED:
+            self.governor.get_bucket(self.service, identity).recover()
+        response.raise_for_status()
+        return response
+
+
+governor = Governor()  # shared by all sessions
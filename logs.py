@@ -0,0 +1,56 @@
+import atexit
+import datetime
+import json
+import logging
+import logging.handlers
+import queue
+
+FIELDS = ('service', 'endpoint', 'entity_id', 'duration')  # structured fields for JSON lines
+
+
+class JsonFormatter(logging.Formatter):
+    """Formats log records as JSON lines, including structured fields if present."""
+
+    def format(self, record):
+        line = {
+            'time': str(datetime.datetime.fromtimestamp(record.created)),
+            'level': record.levelname.lower(),
+            'message': record.getMessage(),
+            }
+        for field in FIELDS:
+            if hasattr(record, field):
+                line[field] = getattr(record, field)
+        return json.dumps(line)
+
+
+class TextFormatter(logging.Formatter):
+    """Formats log records like the good old system.log: timestamp followed by entry."""
+
+    def format(self, record):
+        return str(datetime.datetime.fromtimestamp(record.created)) + ' ' + record.getMessage()
+
+
+def get_logger(settings):
+    """Returns logger writing to rotating log file through a background thread.
+    Logger is only set up once, settings of later calls are ignored."""
+    logger = logging.getLogger('workautomation')
+    if logger.handlers:
+        return logger
+    path = settings.get('path', 'system.log')
+    if settings.get('when'):
+        # rotate by time, e.g. 'midnight'
+        handler = logging.handlers.TimedRotatingFileHandler(
+            path, when=settings['when'], backupCount=settings.get('backups', 5), encoding='utf-8')
+    else:
+        handler = logging.handlers.RotatingFileHandler(
+            path, maxBytes=settings.get('max_bytes', 10 * 1024 * 1024),
+            backupCount=settings.get('backups', 5), encoding='utf-8')
+    handler.setFormatter(JsonFormatter() if settings.get('format') == 'json' else TextFormatter())
+    log_queue = queue.Queue()
+    listener = logging.handlers.QueueListener(log_queue, handler)
+    listener.start()
+    atexit.register(listener.stop)  # flush remaining entries on exit
+    logger.addHandler(logging.handlers.QueueHandler(log_queue))
+    logger.setLevel(settings.get('level', 'info').upper())
+    logger.propagate = False
+    return logger
@@ -1,129 +1,354 @@
 from core import Core
-from zendesk import Zendesk
-from freshbooks import FreshBooks
 from toggl import Toggl
+from aio import AsyncService
+from metrics import metrics
+from merging import MergedEntry, DIMENSIONS
+import asyncio
+import itertools
+import time
 import datetime
-from dateutil import tz, parser
-import requests
 import json
+import os
 import sys
 import traceback
-import webbrowser
-from fuzzywuzzy import process, fuzz
 
 
 class Automation(Core):
     """Provides all automation and integration between the services."""
 
-    def __init__(self):
-        super(Automation, self).__init__()
+    def __init__(self, profile=None):
+        super(Automation, self).__init__(profile)
         self.SKIP_KEYWORDS = ['skip', 'cancel', 'break']
+        self.services = {}  # service objects, kept around so their clients and caches stay warm
+        self.summary = {'projects_created': 0, 'entries_booked': 0}  # counts of last run
+        self.mirror = None
 
-    def sync(self, no_of_days=1):
-        """Turns Freshbooks tickets from the past x days into Toggl projects."""
-        zd = Zendesk()
-        tg = Toggl()
+    def get_service(self, name):
+        """Returns service object ('zendesk', 'toggl' or 'freshbooks'), creates it on first use."""
+        if name not in self.services:
+            # Import services on first use, so commands don't load what they don't need:
+            if name == 'zendesk':
+                from zendesk import Zendesk as service
+            elif name == 'freshbooks':
+                from freshbooks import FreshBooks as service
+            else:
+                service = Toggl
+            self.services[name] = service(self.profile)
+        return self.services[name]
+
+    def get_mirror(self):
+        """Returns local mirror (see mirror.py) if lookups are enabled in config and it exists, else None."""
+        if self.mirror is None and self.mirror_settings.get('lookups') and os.path.exists(self.mirror_path):
+            from mirror import Mirror
+            self.mirror = Mirror(self.profile)
+        return self.mirror
+
+    def sync(self, no_of_days=1, incremental=False):
+        """Turns Zendesk tickets from the past x days into Toggl projects.
+        In incremental mode only tickets changed since the last processed ticket are synced.
+        Returns False if something went wrong."""
         try:
-            self.print("Syncing...")
-            self.print_divider(30)
-            tickets = zd.get_tickets(no_of_days)
-            for ticket in tickets:
-                project_title = self.format_title(ticket.id, ticket.subject)
-                if ticket.organization:
-                    client_id = tg.get_client_id(name=ticket.organization.name)
-                    if not client_id:
-                        new_client = tg.create_client(ticket.organization.name)
-                        client_id = new_client['id']
-                else:
-                    client_id = False
-                    self.print("Ticket '%s' has no associated organization!" % (project_title))
-                all_projects = tg.get_projects()
-                if not self.already_created(ticket.id, all_projects):
-                    self.print("Creating project '%s'..." % (project_title))
-                    result = tg.create_project(project_title, client_id, is_private=False)
-                    self.print("Toggl response:")
-                    self.log(result, silent=False)
-                else:
-                    self.print("There is already a Toggl project for Zendesk ticket #%s!" % ticket.id)
-                    pass
-                    # TODO: edit Toggl project
-                    # tg.edit_project(project_id, name=ticket.subject)
-                self.print_divider(30)
-            self.print("Done!")
+            with metrics.span('sync'):
+                asyncio.run(self.sync_async(no_of_days, incremental))
+            return True
         except:
-            self.log(traceback.format_exc(), silent=False)
-
-    def time_tracking(self):
-        """Starts interactive time tracking session. Updates Freshbooks based on Toggl entries."""
-        fb = FreshBooks()
-        tg = Toggl()
-        self.print_splash()
-        self.print("Tip: You can always enter 'skip' when you want to skip a time entry.", format='warn')
-        days = self.get_interactive_days()  # number of days to go back
-        self.print("OK, I'll run you through the Toggl time entries of the past %i day(s)." % (days))
-        timestamp = self.get_timestamp(days)  # unix timestamp including tz
-        time_entries = tg.get_time_entries(timestamp)
+            self.log(traceback.format_exc(), silent=False, level='error')
+            return False
+        finally:
+            self.report_metrics()
+
+    async def sync_async(self, no_of_days=1, incremental=False):
+        """Asyncio version of sync, independent API calls run at the same time.
+        Tickets are streamed and processed in batches."""
+        zd = self.get_service('zendesk')
+        tg = AsyncService(self.get_service('toggl'), 'toggl')
+        self.print("Syncing...")
+        self.print_divider(30)
+        if incremental:
+            tickets = iter(zd.iter_new_tickets())
+        else:
+            tickets = iter(zd.iter_tickets(no_of_days))
+        next_batch = lambda: list(itertools.islice(tickets, self.batch_size))
+        # Fetch first tickets, projects and clients at the same time:
+        batch, project_index, _ = await asyncio.gather(
+            asyncio.to_thread(next_batch), tg.get_project_index(), tg.get_clients())
+        while batch:
+            with metrics.span('create projects'):
+                await self.sync_tickets(tg, batch, project_index)
+            if incremental:
+                zd.mark_processed(batch[-1])  # tickets come in chronological order
+            batch = await asyncio.to_thread(next_batch)
+        self.print_divider(30)
+        self.print("Done!")
+
+    async def sync_tickets(self, tg, tickets, project_index):
+        """Creates Toggl projects (and clients) for tickets that don't have one yet."""
+        # Only keep tickets that don't have a Toggl project yet:
+        new_tickets = {}
+        for ticket in tickets:
+            if self.already_created(ticket.id, project_index):
+                self.print("There is already a Toggl project for Zendesk ticket #%s!" % ticket.id)
+                # TODO: edit Toggl project
+                # tg.edit_project(project_id, name=ticket.subject)
+            else:
+                new_tickets[ticket.id] = ticket
+        # Resolve (or create) every client once:
+        organizations = list(set(t.organization_name for t in new_tickets.values() if t.organization_name))
+        client_ids = dict(zip(organizations, await asyncio.gather(
+            *[tg.get_or_create_client(name) for name in organizations])))
+        # Create projects concurrently:
+        creates = []
+        for ticket in new_tickets.values():
+            project_title = self.format_title(ticket.id, ticket.subject)
+            if ticket.organization_name:
+                client_id = client_ids[ticket.organization_name]
+            else:
+                client_id = False
+                self.print("Ticket '%s' has no associated organization!" % (project_title))
+            self.print("Creating project '%s'..." % (project_title))
+            creates.append(tg.create_project(project_title, client_id, is_private=False))
+        # A failing create raises, so the batch isn't marked as processed and is synced again next time:
+        for create in asyncio.as_completed(creates):
+            result = await create
+            if isinstance(result, dict) and result.get('data'):
+                self.summary['projects_created'] += 1
+            self.print("Toggl response:")
+            self.log_response(result, silent=False, service='toggl', endpoint='projects')
+
+    async def load_async(self, fb, tg, timestamp, end_timestamp=None):
+        """Loads Toggl time entries, clients and projects and FreshBooks projects at the same time.
+        Time entries are streamed straight into merge_toggl_time_entries, returns merged entries."""
+        load_entries = lambda: self.merge_toggl_time_entries(tg.iter_time_entries(timestamp, end_timestamp))
+        async_fb = AsyncService(fb, 'freshbooks')
+        async_tg = AsyncService(tg, 'toggl')
+        time_entries, _, _, _ = await asyncio.gather(
+            asyncio.to_thread(load_entries), async_tg.get_clients(), async_tg.get_projects(), async_fb.get_projects())
+        return time_entries
+
+    def time_tracking(self, headless=False, days=None, end_date=None, interactive=True):
+        """Starts time tracking session. Updates Freshbooks based on Toggl entries.
+        In headless mode entries are booked according to the rules file without prompting,
+        unresolved entries are asked for at the end (if there is someone to ask and interactive is True).
+        Optionally accepts end date (datetime.date), days are counted back from there instead of today."""
+        from booking import Booking
+        from decisions import Decisions
+        from rules import Rules
+        fb = self.get_service('freshbooks')
+        tg = self.get_service('toggl')
+        booking = Booking(fb, tg)
+        decisions = Decisions(self.profile)  # FreshBooks projects picked before
+        rules = Rules(self.profile) if headless else None
+        if not headless:
+            self.print_splash()
+            self.print("Tip: You can always enter 'skip' when you want to skip a time entry.", format='warn')
+        if days is None:
+            days = self.get_interactive_days()  # number of days to go back
+        if end_date:
+            self.print("OK, I'll run you through the Toggl time entries of %i day(s) up to %s." % (days, end_date))
+            end_timestamp = self.get_end_timestamp(end_date)
+        else:
+            self.print("OK, I'll run you through the Toggl time entries of the past %i day(s)." % (days))
+            end_timestamp = None
+        timestamp = self.get_timestamp(days, end_date)  # isoformat timestamp including tz
+        # Tag entries an earlier (crashed) run booked first, so they aren't merged with new entries:
+        self.summary['entries_booked'] = booking.finish()
+        with metrics.span('fetch entries'):
+            time_entries = asyncio.run(self.load_async(fb, tg, timestamp, end_timestamp))  # merged entries
         if len(time_entries) == 0:
-            self.print("No Toggl entries in this time span!", 'warn')
+            self.print("No billable Toggl entries in this time span!", 'warn')
             return False
-        time_entries = self.merge_toggl_time_entries(time_entries)  # merge Toggl entries
-        fb_projects = fb.get_projects()
+        # Load all projects of these entries at once:
+        with metrics.span('fetch projects'):
+            projects = tg.prefetch_projects(entry.pid for entry in time_entries)
+        unresolved = []  # entries without matching rule
+        started = time.time()
         # Loop through merged Toggl time entries:
         for entry in time_entries:
             # Get and convert all necessary info:
-            client_id = tg.get_client_id(project_id=entry.get('pid'))
-            client_name = tg.get_client_name(client_id)
-            project = tg.get_project(entry.get('pid'))
-            duration = int(entry['duration']) / 60 / 60  # convert duration to hours
-            duration = round(duration * 4 ) / 4  # round hours to nearest .25
-            description = self.format_description(project['name'], entry['description'])
-            date = str(parser.parse(entry['start']).date())
+            project = projects[entry.pid]
+            client_name = tg.get_client_name(project.get('cid'))
+            duration = self.get_hours(entry)
+            description = self.format_description(project['name'], entry.description)
+            date = entry.date
             # Print info in a nice way:
             self.print_divider(30)
             self.print("Description: " + description)
             self.print("Date: " + date)
             self.print("Hours spent: " + str(duration))
             # Skip if Toggl entry is already booked:
-            if entry.get('tags') and tg.BOOKED_TAG in entry['tags']:
+            if entry.booked:
                 self.print("Skipping this entry because it is already in Freshbooks.", 'cross')
+            # Skip if entry was booked in an earlier run, but not tagged yet:
+            elif booking.get_status(entry.merged_ids) in ('pending', 'booked'):
+                self.print("Skipping this entry because it is already in the booking journal.", 'cross')
             # Skip if duration is below 0.25:
             elif duration < 0.25:
                 self.print("Skipping this entry because there are less than 0.25 hours spent.", 'cross')
             # If billable, add to Freshbooks:
-            elif entry['billable']:
-                # Get FreshBooks project name through interactive search:
-                try:
-                    self.print("Project: \U0001F50D ")
-                    fb_project_name = self.interactive_search(fb_projects.keys(), client_name)
-                # Handle KeyboardInterrupt
-                except KeyboardInterrupt:
-                    answer = input("\nKeyboardInterrupt! Skip current entry or quit time tracking? (S/q) ")
-                    if answer.lower() == 's' or answer == '':
-                        self.clear_lines(1)
-                        self.print("Skipping this entry.", 'cross')
-                        continue
-                    else:
-                        self.clear_lines(1)
-                        self.print("Ok, stopping time tracking.", 'cross')
-                        sys.exit()
-                # If user requests so, skip this entry:
-                self.clear_lines(1)
-                if not fb_project_name:
-                    self.print("Skipping this entry.", 'cross')
-                    continue
-                # Otherwise, add entry to FreshBooks and tag Toggl entry/entries:
-                self.print("Project: " + fb_project_name)
-                project_id = fb.get_project_id(fb_project_name)
-                fb.add_entry(project_id, duration, description, date)
-                tg.tag_projects(entry['merged_ids'], tg.BOOKED_TAG)
+            elif entry.billable:
+                booked_entry = (client_name, duration, description, date, entry.merged_ids)
+                # Book according to rules in headless mode:
+                if rules:
+                    if (not self.book_by_rules(fb, booking, rules, project['name'], *booked_entry) and
+                            not self.book_by_decision(fb, booking, decisions, project['name'], *booked_entry)):
+                        self.print("No rule matches this entry, will ask about it at the end.", 'warn')
+                        unresolved.append((project['name'], booked_entry))
+                # Otherwise use earlier decision or get FreshBooks project name through interactive search:
+                elif not self.book_by_decision(fb, booking, decisions, project['name'], *booked_entry):
+                    if not self.book_interactively(fb, booking, *booked_entry, project_name=project['name'],
+                                                   decisions=decisions):
+                        break
             # If not billable, skip entry:
             else:
                 self.print("Skipping this entry because it is not billable.", 'cross')
+        # Ask about entries without a matching rule:
+        if unresolved and interactive and sys.stdin.isatty():
+            self.print_divider(30)
+            self.print("%i entries couldn't be booked by rules, please choose a project:" % len(unresolved), 'warn')
+            for project_name, booked_entry in unresolved:
+                self.print_divider(30)
+                self.print("Description: " + booked_entry[2])
+                self.print("Date: " + booked_entry[3])
+                self.print("Hours spent: " + str(booked_entry[1]))
+                if not self.book_interactively(fb, booking, *booked_entry, project_name=project_name,
+                                               decisions=decisions):
+                    break
+        elif unresolved:
+            for project_name, booked_entry in unresolved:
+                self.log("No rule for '%s' on %s, not booked." % (booked_entry[2], booked_entry[3]), silent=False)
+        metrics.record_span('match', time.time() - started)
+        decisions.save()
         self.print_divider(30)
+        # Add all planned entries to FreshBooks and tag Toggl entries:
+        self.summary['entries_booked'] += booking.commit()
+        self.report_metrics()
+        if headless:
+            return True
         answer = input("All done! Open FreshBooks in browser to verify? (Y/n) ")
         if answer.lower() == 'y' or answer == '':
+            import webbrowser
             webbrowser.open('https://%s.freshbooks.com/timesheet' % fb.fb_creds['subdomain'])
 
+    def warm_cache(self):
+        """Loads Toggl clients and projects and FreshBooks projects into the cache at the same time,
+        so the next sync or time tracking session doesn't have to wait for them.
+        Returns False if something went wrong."""
+        tg = self.get_service('toggl')
+        fb = self.get_service('freshbooks')
+
+        async def refresh():
+            await asyncio.gather(asyncio.to_thread(tg.refresh), asyncio.to_thread(fb.refresh))
+
+        try:
+            with metrics.span('warm cache'):
+                asyncio.run(refresh())
+            self.print("Cached %i Toggl projects and %i FreshBooks projects." % (
+                len(tg.projects), len(fb.projects)), 'ok')
+            return True
+        except:
+            self.log(traceback.format_exc(), silent=False, level='error')
+            return False
+
+    def print_status(self):
+        """Prints state on disk: cache ages, Zendesk high-water mark, booking journal and daemon status.
+        Only reads files, doesn't touch any API."""
+        from cache import Cache
+        self.print("Profile: %s" % (self.profile or 'default'))
+        now = time.time()
+        for key, entry in sorted(Cache(self.profile).entries.items()):
+            state = 'invalid' if entry.get('invalid') else '%i minutes old' % ((now - entry['fetched_at']) / 60)
+            self.print("Cache '%s': %s" % (key, state))
+        try:
+            with open(self.zendesk_mark_path, 'r') as mark_file:
+                mark = datetime.datetime.fromtimestamp(json.load(mark_file)['timestamp'])
+            self.print("Zendesk tickets synced up to %s." % mark)
+        except (IOError, ValueError, KeyError):
+            self.print("No incremental Zendesk sync yet.")
+        statuses = {}
+        try:
+            with open(self.journal_path, 'r') as journal_file:
+                for line in journal_file:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        continue
+                    statuses[record['key']] = record['status']
+        except IOError:
+            pass
+        counts = {}
+        for status in statuses.values():
+            counts[status] = counts.get(status, 0) + 1
+        self.print("Booking journal: %s" % (', '.join('%i %s' % (counts[s], s) for s in sorted(counts)) or 'empty'))
+        if counts.get('pending'):
+            self.print("Some entries are pending, check if they made it into FreshBooks!", 'warn')
+        try:
+            with open(self.daemon.get('status_path', 'daemon_status.json'), 'r') as status_file:
+                status = json.load(status_file)
+            self.print("Sync daemon: %i syncs (%i failed), last sync %s, next sync %s." % (
+                status['syncs'], status['failed_syncs'], status['last_sync'], status['next_sync']))
+        except (IOError, ValueError, KeyError):
+            self.print("Sync daemon isn't running.")
+
+    def book_by_rules(self, fb, booking, rules, project_name, client_name, duration, description, date, toggl_ids):
+        """Plans entry for booking in FreshBooks project given by first matching rule.
+        Returns False if no rule matches."""
+        rule = rules.resolve(client_name, project_name)
+        if not rule:
+            return False
+        project_id = rule.get('freshbooks_project_id') or fb.get_project_id(rule.get('freshbooks_project'))
+        if not project_id:
+            self.log("Rule refers to unknown FreshBooks project '%s'." % rule.get('freshbooks_project'), silent=False)
+            return False
+        self.print("Project: " + str(rule.get('freshbooks_project', project_id)))
+        booking.add(project_id, duration, description, date, toggl_ids, rule['task_id'])
+        return True
+
+    def book_by_decision(self, fb, booking, decisions, project_name, client_name, duration, description, date,
+                         toggl_ids):
+        """Plans entry for booking in FreshBooks project picked for this client and project before.
+        Returns False if there is no such decision."""
+        fb_projects = fb.get_projects()
+        fb_project_name = decisions.resolve(client_name, project_name, fb_projects)
+        if not fb_project_name:
+            return False
+        self.print("Project: %s (picked before)" % fb_project_name)
+        booking.add(fb_projects[fb_project_name], duration, description, date, toggl_ids)
+        return True
+
+    def book_interactively(self, fb, booking, client_name, duration, description, date, toggl_ids,
+                           project_name=None, decisions=None):
+        """Lets user pick FreshBooks project for entry and plans entry for booking.
+        The choice is remembered in decisions, if specified, and earlier choices for the client are suggested.
+        Returns False if user wants to stop time tracking."""
+        # Suggest project picked for another project of this client before, the user still confirms it:
+        suggestion = decisions.suggest(client_name, fb.get_projects()) if decisions else None
+        try:
+            self.print("Project: \U0001F50D ")
+            fb_project_name = self.interactive_search(fb.get_projects().keys(), suggestion or client_name)
+        # Handle KeyboardInterrupt
+        except KeyboardInterrupt:
+            answer = input("\nKeyboardInterrupt! Skip current entry or quit time tracking? (S/q) ")
+            if answer.lower() == 's' or answer == '':
+                self.clear_lines(1)
+                self.print("Skipping this entry.", 'cross')
+                return True
+            else:
+                self.clear_lines(1)
+                self.print("Ok, stopping time tracking.", 'cross')
+                return False
+        # If user requests so, skip this entry:
+        self.clear_lines(1)
+        if not fb_project_name:
+            self.print("Skipping this entry.", 'cross')
+            return True
+        # Otherwise, plan entry for booking in FreshBooks:
+        self.print("Project: " + fb_project_name)
+        project_id = fb.get_project_id(fb_project_name)
+        booking.add(project_id, duration, description, date, toggl_ids)
+        if decisions:
+            decisions.remember(client_name, project_name, fb_project_name)
+        return True
+
     def interactive_search(self, choices, query=None):
         """Starts interactive search, allows user to make a selection.
         Accepts array of strings and optional (user) query. Returns string chosen by user."""
@@ -151,7 +376,7 @@ class Automation(Core):
         Prompts user if unsure about best match."""
         if query in self.SKIP_KEYWORDS:
             return None
-        results = process.extract(query, choices, limit=10)  # fuzzy string matching
+        results = self.get_match_index(choices).extract(query, limit=10)  # fuzzy string matching
         best_match = results[0]
         second_best_match = results[1]
         if best_match[1] == second_best_match[1] or best_match[1] < 50:  # if inconclusive or low score
@@ -182,12 +407,14 @@ class Automation(Core):
                 days = 1
         return days
 
-    def already_created(self, ticket_id, toggl_projects):
-        """Hacky way to check if this function already made a Toggl project based on a Zendesk ticket ID."""
-        project_prepends = [p['name'].split()[0][1:] for p in toggl_projects]
-        if str(ticket_id) in project_prepends:
+    def already_created(self, ticket_id, project_index):
+        """Hacky way to check if this function already made a Toggl project based on a Zendesk ticket ID.
+        Accepts ticket id to project mapping, see Toggl.get_project_index. Also checks the mirror,
+        which remembers projects that were archived since."""
+        if str(ticket_id) in project_index:
             return True
-        return False
+        mirror = self.get_mirror()
+        return bool(mirror and mirror.has_ticket_project(ticket_id))
 
     def format_title(self, ticket_id, subject):
         """Formats id and subject into a suitable (Freshbooks) title."""
@@ -195,47 +422,57 @@ class Automation(Core):
         title = "#%i %s" % (ticket_id, subject)
         return title.strip()
 
+    def get_hours(self, entry):
+        """Returns duration of merged entry in hours, rounded to the nearest .25 like it's booked."""
+        duration = int(entry.duration) / 60 / 60  # convert duration to hours
+        return round(duration * 4 ) / 4  # round hours to nearest .25
+
     def format_description(self, project_name, description):
         """Formats Toggl project name and description into (Freshbooks) description."""
         description = description if description else ''
         return "%s %s" % (project_name, '- ' + description)
 
-    def merge_toggl_time_entries(self, time_entries):
-        """Merges toggle time entries with same project name. Sums duration if billable."""
-        tg = Toggl()
-        d = {}
+    def merge_toggl_time_entries(self, time_entries, group_by=('project', 'day')):
+        """Merges billable Toggl time entries in a single pass, by default per project per day.
+        Can also group by 'week' and 'tag'. Booked and unbooked entries are never merged.
+        Returns list of MergedEntry records."""
+        dimensions = [DIMENSIONS[dimension] for dimension in group_by]
+        merged = {}
+        duration = 0  # entries are usually streamed while they're fetched, so only time the merging itself
         for entry in time_entries:
-            if entry.get('billable'):
-                if entry.get('tags') and tg.BOOKED_TAG in entry['tags']:
-                    status = 'booked'
-                else:
-                    status = 'not-booked'
-                date = parser.parse(entry['start']).date()
-                if not entry.get('pid'):
-                    self.log("Couldn't find associated project for entry: %s" % (str(entry)))
-                    continue
-                unique_id = str(entry['pid']) + str(date) + status
-                if not entry.get('description'):
-                    entry['description'] = ""
-                if d.get(unique_id):
-                    d[unique_id]['duration'] += entry['duration']
-                    d[unique_id]['merged_ids'].append(entry['id'])
-                    if d[unique_id].get('description'):
-                        if entry['description'].strip() not in d[unique_id]['description']:
-                            d[unique_id]['description'] += ' / ' + entry['description']
-                    else:
-                        d[unique_id]['description'] = entry['description']
-                else:
-                    entry['merged_ids'] = [entry['id']]
-                    d[unique_id] = entry
-        return d.values()
+            started = time.time()
+            self.merge_time_entry(merged, dimensions, entry)
+            duration += time.time() - started
+        metrics.record_span('merge', duration)
+        return list(merged.values())
+
+    def merge_time_entry(self, merged, dimensions, entry):
+        """Adds Toggl time entry to its MergedEntry in dictionary merged, skips unbillable entries."""
+        if not entry.get('billable'):
+            return
+        if not entry.get('pid'):
+            self.log("Couldn't find associated project for entry: %s" % (str(entry)))
+            return
+        booked = Toggl.BOOKED_TAG in (entry.get('tags') or ())
+        date = entry['start'][:10]  # ISO timestamp, so no need to parse
+        key = (booked,) + tuple(dimension(entry, date) for dimension in dimensions)
+        record = merged.get(key)
+        if record is None:
+            record = merged[key] = MergedEntry(entry['pid'], date, booked)
+        record.add(entry)
 
-    def get_timestamp(self, days=1):
+    def get_timestamp(self, days=1, end_date=None):
         """Returns isoformat string of beginning of past x day(s).
+        Counts back from end_date (datetime.date) if specified, otherwise from today.
         Assumes Europe/Amsterdam locale."""
-        offset = datetime.datetime.utcnow().date() - datetime.timedelta(days=days-1)
+        end_date = end_date if end_date else datetime.datetime.utcnow().date()
+        offset = end_date - datetime.timedelta(days=days-1)
         # est = tz.gettz('Europe/Amsterdam')
         # temporary dirty fix for timezone:
         timezone = '+02:00'
         start = datetime.datetime(offset.year, offset.month, offset.day)
         return start.isoformat() + timezone
+
+    def get_end_timestamp(self, end_date):
+        """Returns isoformat string of end of end_date (datetime.date), i.e. beginning of the next day."""
+        return self.get_timestamp(0, end_date)
@@ -0,0 +1,57 @@
+from fuzzywuzzy import process, fuzz, utils
+
+
+class MatchIndex():
+    """Precomputed fuzzy matching index for a fixed list of choices.
+    Choices are normalized once and indexed by n-gram, so a query is first only scored
+    against choices that share n-grams with it. Scoring itself is done by fuzzywuzzy,
+    so scores and ranking are the same as for process.extract."""
+
+    # WRatio only scores above 95 if the plain ratio does, i.e. if the strings are nearly the same,
+    # which they can't be without sharing words (and so n-grams). Other choices score 95 at most:
+    NON_SHARED_MAX = 95
+
+    def __init__(self, choices, ngram_size=3):
+        self.choices = list(choices)
+        self.ngram_size = ngram_size
+        self.index = {}  # n-gram -> list of choice positions
+        for position, choice in enumerate(self.choices):
+            for ngram in self.get_ngrams(choice):
+                self.index.setdefault(ngram, []).append(position)
+        self.results = {}  # memoized results per query, limit and scorer
+
+    def get_ngrams(self, string):
+        """Returns set of n-grams of all (normalized) words in string."""
+        ngrams = set()
+        for word in utils.full_process(string).split():
+            word = ' %s ' % word  # pad so short words get n-grams too
+            for i in range(max(len(word) - self.ngram_size + 1, 1)):
+                ngrams.add(word[i:i + self.ngram_size])
+        return ngrams
+
+    def get_candidates(self, query):
+        """Returns set of positions of choices sharing n-grams with query."""
+        positions = set()
+        for ngram in self.get_ngrams(query):
+            positions.update(self.index.get(ngram, ()))
+        return positions
+
+    def score(self, query, positions, limit, scorer):
+        """Returns list of (choice, score, position) tuples of best matches among choices at positions.
+        Positions are scored in original order, so ties rank like they do in process.extract."""
+        return process.extract(query, {p: self.choices[p] for p in sorted(positions)}, limit=limit, scorer=scorer)
+
+    def extract(self, query, limit=5, scorer=fuzz.WRatio):
+        """Returns list of (choice, score) tuples of best matches, like process.extract.
+        Choices sharing n-grams with query are scored first. Only if some result scores NON_SHARED_MAX
+        or less, the other choices (e.g. short words or swapped letters) could rank higher and are scored too."""
+        key = (query, limit, scorer)
+        if key not in self.results:
+            candidates = self.get_candidates(query)
+            results = self.score(query, candidates, limit, scorer)
+            if scorer is not fuzz.WRatio or len(results) < limit or results[-1][1] <= self.NON_SHARED_MAX:
+                others = set(range(len(self.choices))) - candidates
+                results += self.score(query, others, limit, scorer)
+                results = sorted(results, key=lambda result: (-result[1], result[2]))[:limit]
+            self.results[key] = [(choice, score) for choice, score, position in results]
+        return self.results[key]
@@ -0,0 +1,46 @@
+import datetime
+
+
+class MergedEntry():
+    """Compact record of Toggl time entries that are booked as a single FreshBooks entry."""
+
+    __slots__ = ('pid', 'date', 'booked', 'billable', 'duration', 'descriptions', 'merged_ids')
+
+    def __init__(self, pid, date, booked, billable=True):
+        self.pid = pid
+        self.date = date  # date of first entry, as 'YYYY-MM-DD' string
+        self.booked = booked  # True if entries are tagged as booked
+        self.billable = billable
+        self.duration = 0  # total duration in seconds
+        self.descriptions = {}  # unique descriptions, dictionary used as ordered set
+        self.merged_ids = []  # ids of merged Toggl entries
+
+    @property
+    def description(self):
+        """Returns all unique descriptions of merged entries joined together."""
+        return ' / '.join(self.descriptions)
+
+    def add(self, entry):
+        """Merges Toggl time entry into this record."""
+        self.duration += entry['duration']
+        self.merged_ids.append(entry['id'])
+        description = (entry.get('description') or '').strip()
+        if description:
+            self.descriptions[description] = None
+        date = entry['start'][:10]
+        if date < self.date:
+            self.date = date
+
+
+def get_week(date):
+    """Returns (year, week number) tuple of 'YYYY-MM-DD' date string."""
+    return datetime.date.fromisoformat(date).isocalendar()[:2]
+
+
+# Functions returning the value of a dimension that entries can be grouped by:
+DIMENSIONS = {
+    'project': lambda entry, date: entry.get('pid'),
+    'day': lambda entry, date: date,
+    'week': lambda entry, date: get_week(date),
+    'tag': lambda entry, date: tuple(sorted(entry.get('tags') or ())),
+    }
@@ -0,0 +1,131 @@
+from collections import deque
+from contextlib import contextmanager
+import os
+import re
+import threading
+import time
+
+
+class Metrics():
+    """Collects latency, status and size of outbound API calls and timing of automation phases."""
+
+    def __init__(self, window=10000):
+        self.lock = threading.Lock()
+        self.window = window  # max number of calls/spans to keep per endpoint/phase
+        self.calls = {}  # (service, endpoint) -> (status, bytes, latency) tuples
+        self.spans = {}  # phase name -> durations
+        self.limits = {}  # service -> [seconds waited for rate limits, number of throttled calls]
+
+    def get_endpoint(self, response):
+        """Returns endpoint of response with ids stripped, e.g. 'GET /api/v8/projects/{id}'.
+        For the FreshBooks XML API the method in the request body is used."""
+        request = response.request
+        path = re.sub(r'/[0-9][0-9,]*', '/{id}', request.path_url.split('?')[0])
+        if path.endswith('/xml-in') and request.body:
+            body = request.body.decode('utf-8', 'ignore') if isinstance(request.body, bytes) else request.body
+            method = re.search(r'method="([\w.]+)"', body)
+            if method:
+                return method.group(1)
+        return '%s %s' % (request.method, path)
+
+    def get_hook(self, service):
+        """Returns requests response hook recording every call of service."""
+        def record(response, *args, **kwargs):
+            self.record_call(service, self.get_endpoint(response), response.status_code,
+                             len(response.content), response.elapsed.total_seconds())
+        return record
+
+    def record_call(self, service, endpoint, status, size, latency):
+        """Records a single API call."""
+        with self.lock:
+            self.calls.setdefault((service, endpoint), deque(maxlen=self.window)).append((status, size, latency))
+
+    def record_wait(self, service, seconds):
+        """Records time a call of service waited for the rate limit governor."""
+        with self.lock:
+            self.limits.setdefault(service, [0.0, 0])[0] += seconds
+
+    def record_throttle(self, service):
+        """Records a call of service that was throttled (429) by the API."""
+        with self.lock:
+            self.limits.setdefault(service, [0.0, 0])[1] += 1
+
+    @contextmanager
+    def span(self, phase):
+        """Context manager timing a phase of the automation, e.g. 'merge'."""
+        started = time.time()
+        try:
+            yield
+        finally:
+            self.record_span(phase, time.time() - started)
+
+    def record_span(self, phase, duration):
+        """Records duration (in seconds) of a phase of the automation."""
+        with self.lock:
+            self.spans.setdefault(phase, deque(maxlen=self.window)).append(duration)
+
+    def percentile(self, values, percentile):
+        """Returns percentile (0-100) of sorted list of values, using nearest rank."""
+        rank = max(int(round(percentile / 100.0 * len(values) + 0.5)) - 1, 0)
+        return values[min(rank, len(values) - 1)]
+
+    def get_summary(self):
+        """Returns end of run summary as list of lines."""
+        lines = []
+        with self.lock:
+            if self.calls:
+                lines.append('%-12s %-40s %6s %6s %10s %8s %8s %8s' % (
+                    'service', 'endpoint', 'calls', 'errors', 'bytes', 'p50', 'p95', 'p99'))
+                for (service, endpoint), calls in sorted(self.calls.items()):
+                    latencies = sorted(call[2] for call in calls)
+                    lines.append('%-12s %-40s %6i %6i %10i %8.3f %8.3f %8.3f' % (
+                        service, endpoint[:40], len(calls), len([c for c in calls if c[0] >= 400]),
+                        sum(call[1] for call in calls), self.percentile(latencies, 50),
+                        self.percentile(latencies, 95), self.percentile(latencies, 99)))
+            for service, (waited, throttled) in sorted(self.limits.items()):
+                if waited >= 0.001 or throttled:
+                    lines.append('Rate limit %-15s %8.3fs waited, %i calls throttled' % (service, waited, throttled))
+            for phase, durations in self.spans.items():
+                lines.append('Phase %-20s %8.3fs (%ix)' % (phase, sum(durations), len(durations)))
+        return lines
+
+    def write_textfile(self, path):
+        """Writes metrics in Prometheus text format, e.g. for node_exporter's textfile collector."""
+        lines = [
+            '# TYPE workautomation_api_request_duration_seconds summary',
+            ]
+        with self.lock:
+            for (service, endpoint), calls in sorted(self.calls.items()):
+                labels = 'service="%s",endpoint="%s"' % (service, endpoint.replace('"', ''))
+                latencies = sorted(call[2] for call in calls)
+                for quantile in (50, 95, 99):
+                    lines.append('workautomation_api_request_duration_seconds{%s,quantile="%s"} %f' % (
+                        labels, quantile / 100.0, self.percentile(latencies, quantile)))
+                lines.append('workautomation_api_request_duration_seconds_sum{%s} %f' % (labels, sum(latencies)))
+                lines.append('workautomation_api_request_duration_seconds_count{%s} %i' % (labels, len(calls)))
+            lines.append('# TYPE workautomation_api_request_errors_total counter')
+            for (service, endpoint), calls in sorted(self.calls.items()):
+                labels = 'service="%s",endpoint="%s"' % (service, endpoint.replace('"', ''))
+                lines.append('workautomation_api_request_errors_total{%s} %i' % (
+                    labels, len([c for c in calls if c[0] >= 400])))
+            lines.append('# TYPE workautomation_api_response_bytes_total counter')
+            for (service, endpoint), calls in sorted(self.calls.items()):
+                labels = 'service="%s",endpoint="%s"' % (service, endpoint.replace('"', ''))
+                lines.append('workautomation_api_response_bytes_total{%s} %i' % (
+                    labels, sum(call[1] for call in calls)))
+            lines.append('# TYPE workautomation_rate_limit_wait_seconds_total counter')
+            for service, (waited, throttled) in sorted(self.limits.items()):
+                lines.append('workautomation_rate_limit_wait_seconds_total{service="%s"} %f' % (service, waited))
+            lines.append('# TYPE workautomation_rate_limit_throttled_total counter')
+            for service, (waited, throttled) in sorted(self.limits.items()):
+                lines.append('workautomation_rate_limit_throttled_total{service="%s"} %i' % (service, throttled))
+            lines.append('# TYPE workautomation_phase_duration_seconds_total counter')
+            for phase, durations in self.spans.items():
+                lines.append('workautomation_phase_duration_seconds_total{phase="%s"} %f' % (phase, sum(durations)))
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'w') as textfile:
+            textfile.write('\n'.join(lines) + '\n')
+        os.replace(tmp_path, path)
+
+
+metrics = Metrics()  # shared by all service objects
@@ -0,0 +1,180 @@
+from core import Core
+from concurrent.futures import ThreadPoolExecutor
+import datetime
+import json
+import sqlite3
+import threading
+import time
+
+
+class Mirror(Core):
+    """Local SQLite copy of Toggl, FreshBooks and Zendesk data, kept up to date incrementally.
+    Answers lookups and reports with indexed queries, without touching the network."""
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS clients (id INTEGER PRIMARY KEY, name TEXT);
+        CREATE INDEX IF NOT EXISTS clients_name ON clients (name);
+        CREATE TABLE IF NOT EXISTS projects (id INTEGER PRIMARY KEY, name TEXT, cid INTEGER, ticket_id INTEGER);
+        CREATE INDEX IF NOT EXISTS projects_ticket_id ON projects (ticket_id);
+        CREATE TABLE IF NOT EXISTS time_entries (
+            id INTEGER PRIMARY KEY, pid INTEGER, start TEXT, date TEXT, duration INTEGER,
+            description TEXT, billable INTEGER, booked INTEGER, tags TEXT);
+        CREATE INDEX IF NOT EXISTS time_entries_start ON time_entries (start);
+        CREATE INDEX IF NOT EXISTS time_entries_unbooked ON time_entries (billable, booked, date);
+        CREATE TABLE IF NOT EXISTS freshbooks_projects (id INTEGER PRIMARY KEY, name TEXT);
+        CREATE TABLE IF NOT EXISTS tickets (
+            id INTEGER PRIMARY KEY, subject TEXT, organization TEXT, status TEXT,
+            created_at TEXT, updated_at TEXT);
+        CREATE INDEX IF NOT EXISTS tickets_created_at ON tickets (created_at);
+        CREATE TABLE IF NOT EXISTS marks (name TEXT PRIMARY KEY, value TEXT);
+        """
+
+    def __init__(self, profile=None):
+        super(Mirror, self).__init__(profile)
+        self.lock = threading.Lock()  # one connection, shared by the update jobs
+        self.connection = sqlite3.connect(self.mirror_path, check_same_thread=False)
+        self.connection.executescript(self.SCHEMA)
+
+    def query(self, sql, parameters=()):
+        """Returns all rows of query."""
+        with self.lock:
+            return self.connection.execute(sql, parameters).fetchall()
+
+    def write(self, statements):
+        """Executes list of (sql, rows) statements in a single transaction."""
+        with self.lock, self.connection:
+            for sql, rows in statements:
+                self.connection.executemany(sql, rows)
+
+    def get_mark(self, name):
+        """Returns how far update job name got last time (string), or None."""
+        rows = self.query('SELECT value FROM marks WHERE name = ?', (name,))
+        return rows[0][0] if rows else None
+
+    def get_mark_statement(self, name, value):
+        """Returns statement saving mark of update job, to write with the job's data."""
+        return ('INSERT OR REPLACE INTO marks (name, value) VALUES (?, ?)', [(name, str(value))])
+
+    def update(self, automation, days=None):
+        """Updates mirror with data of automation's services, all jobs run at the same time.
+        On the first run time entries and tickets of the past days are loaded, afterwards only
+        what changed since the last update. Returns dictionary with number of rows per job."""
+        days = days or self.mirror_settings.get('days', 90)
+        jobs = {
+            'clients': lambda: self.update_clients(automation.get_service('toggl')),
+            'projects': lambda: self.update_projects(automation.get_service('toggl')),
+            'time_entries': lambda: self.update_time_entries(automation.get_service('toggl'), days),
+            'freshbooks_projects': lambda: self.update_freshbooks_projects(automation.get_service('freshbooks')),
+            'tickets': lambda: self.update_tickets(automation.get_service('zendesk'), days),
+            }
+        with ThreadPoolExecutor(max_workers=len(jobs)) as pool:
+            futures = {name: pool.submit(job) for name, job in jobs.items()}
+        counts = {name: future.result() for name, future in futures.items()}
+        for name, count in counts.items():
+            self.print("Mirrored %i %s." % (count, name.replace('_', ' ')), 'ok')
+        return counts
+
+    def update_clients(self, toggl):
+        """Replaces mirrored Toggl clients."""
+        rows = [(client_id, name) for name, client_id in toggl.get_clients().items()]
+        self.write([('DELETE FROM clients', [()]),
+                    ('INSERT INTO clients (id, name) VALUES (?, ?)', rows)])
+        return len(rows)
+
+    def update_projects(self, toggl):
+        """Adds or updates mirrored Toggl projects. Projects that disappear from the API
+        (archived or deleted) are kept, so their tickets are still known to have a project."""
+        rows = []
+        for project in toggl.get_projects():
+            words = project.get('name', '').split()
+            ticket_id = words[0][1:] if words and words[0].startswith('#') else None
+            rows.append((project['id'], project.get('name'), project.get('cid'),
+                         int(ticket_id) if ticket_id and ticket_id.isdigit() else None))
+        self.write([('INSERT OR REPLACE INTO projects (id, name, cid, ticket_id) VALUES (?, ?, ?, ?)', rows)])
+        return len(rows)
+
+    def update_time_entries(self, toggl, days):
+        """Replaces mirrored Toggl time entries since the last update (minus some overlap days,
+        because recent entries still get edited and tagged), or of the past days on the first run."""
+        now = datetime.datetime.now(datetime.timezone.utc).replace(microsecond=0)
+        mark = self.get_mark('time_entries')
+        if mark:
+            overlap = datetime.timedelta(days=self.mirror_settings.get('overlap_days', 7))
+            start = datetime.datetime.fromisoformat(mark) - overlap
+        else:
+            start = now - datetime.timedelta(days=days)
+        rows = []
+        for entry in toggl.iter_time_entries(start.isoformat(), now.isoformat()):
+            tags = entry.get('tags') or []
+            rows.append((entry['id'], entry.get('pid'), entry['start'], entry['start'][:10], entry['duration'],
+                         entry.get('description'), bool(entry.get('billable')), toggl.BOOKED_TAG in tags,
+                         json.dumps(tags)))
+        # Entries deleted in Toggl disappear from the window, so replace the whole window:
+        self.write([('DELETE FROM time_entries WHERE start >= ? AND start < ?', [(start.isoformat(), now.isoformat())]),
+                    ('INSERT OR REPLACE INTO time_entries (id, pid, start, date, duration, description, billable, '
+                     'booked, tags) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)', rows),
+                    self.get_mark_statement('time_entries', now.isoformat())])
+        return len(rows)
+
+    def update_freshbooks_projects(self, freshbooks):
+        """Replaces mirrored FreshBooks projects."""
+        rows = [(project_id, name) for name, project_id in freshbooks.get_projects().items()]
+        self.write([('DELETE FROM freshbooks_projects', [()]),
+                    ('INSERT INTO freshbooks_projects (id, name) VALUES (?, ?)', rows)])
+        return len(rows)
+
+    def update_tickets(self, zendesk, days):
+        """Adds or updates mirrored Zendesk tickets changed since the last update,
+        or of the past days on the first run. Has its own mark, independent of sync."""
+        mark = self.get_mark('tickets')
+        start_time = int(mark) if mark else int(time.time()) - days * 24 * 60 * 60
+        rows = []
+        for ticket in zendesk.iter_new_tickets(start_time):
+            rows.append((ticket.id, ticket.subject, ticket.organization_name, ticket.status,
+                         ticket.created_at, ticket.updated_at))
+            start_time = max(start_time, zendesk.get_ticket_timestamp(ticket))
+        self.write([('INSERT OR REPLACE INTO tickets (id, subject, organization, status, created_at, updated_at) '
+                     'VALUES (?, ?, ?, ?, ?, ?)', rows),
+                    self.get_mark_statement('tickets', start_time)])
+        return len(rows)
+
+    def has_ticket_project(self, ticket_id):
+        """Checks if a Toggl project was ever made for Zendesk ticket."""
+        return bool(self.query('SELECT 1 FROM projects WHERE ticket_id = ? LIMIT 1', (int(ticket_id),)))
+
+    def get_unbooked_entries(self, since):
+        """Returns (project, date, hours) of billable time entries not booked since date ('YYYY-MM-DD')."""
+        return self.query("""
+            SELECT coalesce(projects.name, '(no project)'), time_entries.date, sum(time_entries.duration) / 3600.0
+            FROM time_entries LEFT JOIN projects ON projects.id = time_entries.pid
+            WHERE time_entries.billable = 1 AND time_entries.booked = 0 AND time_entries.date >= ?
+              AND time_entries.duration > 0
+            GROUP BY time_entries.pid, time_entries.date ORDER BY time_entries.date""", (since,))
+
+    def get_tickets_without_project(self, since):
+        """Returns (id, subject, organization) of tickets created since date without Toggl project."""
+        return self.query("""
+            SELECT tickets.id, tickets.subject, tickets.organization FROM tickets
+            WHERE tickets.created_at >= ? AND tickets.status != 'deleted'
+              AND NOT EXISTS (SELECT 1 FROM projects WHERE projects.ticket_id = tickets.id)
+            ORDER BY tickets.created_at""", (since,))
+
+    def print_report(self, days=30):
+        """Prints unbooked billable entries and tickets without Toggl project of the past days."""
+        since = str(datetime.date.today() - datetime.timedelta(days=days))
+        marks = dict(self.query('SELECT name, value FROM marks'))
+        if not marks:
+            self.print("Mirror is empty, run 'python cli.py mirror' first.", 'warn')
+            return
+        self.print("Report of the past %i day(s), time entries mirrored up to %s." % (
+            days, marks.get('time_entries', 'never')))
+        self.print_divider(30)
+        entries = self.get_unbooked_entries(since)
+        self.print("%i unbooked billable entries (%.2f hours):" % (len(entries), sum(e[2] for e in entries)))
+        for project, date, hours in entries:
+            self.print("  %s  %6.2f  %s" % (date, hours, project))
+        self.print_divider(30)
+        tickets = self.get_tickets_without_project(since)
+        self.print("%i tickets without Toggl project:" % len(tickets))
+        for ticket_id, subject, organization in tickets:
+            self.print("  #%i %s (%s)" % (ticket_id, subject, organization or 'no organization'))
@@ -0,0 +1,72 @@
+from core import Core
+from concurrent.futures import ThreadPoolExecutor
+import threading
+import time
+import traceback
+
+
+class SharedData():
+    """Data that is loaded once and shared by all profiles of a run (e.g. projects of a shared FreshBooks)."""
+
+    def __init__(self):
+        self.data = {}
+        self.locks = {}  # one lock per key, so profiles wait for each other instead of loading twice
+        self.lock = threading.Lock()
+
+    def get_or_load(self, key, loader):
+        """Returns data for key, calls loader to load it if it isn't loaded yet."""
+        with self.lock:
+            key_lock = self.locks.setdefault(key, threading.Lock())
+        with key_lock:
+            if key not in self.data:
+                self.data[key] = loader()
+            return self.data[key]
+
+
+class ProfileRunner(Core):
+    """Runs sync and/or headless booking for multiple profiles (see 'profiles' in config) at once.
+    Profiles run in parallel, sessions and data of shared accounts are loaded once."""
+
+    def __init__(self, names=None):
+        super(ProfileRunner, self).__init__()
+        self.names = names or sorted(self.profiles)
+        unknown = [name for name in self.names if name not in self.profiles]
+        if unknown:
+            raise ValueError("Unknown profile(s) %s, check 'profiles' in config!" % ', '.join(unknown))
+
+    def run_profile(self, name, sync_days=None, booking_days=None, incremental=False):
+        """Runs sync and/or headless booking for a single profile. Returns summary dictionary."""
+        from main import Automation
+        started = time.time()
+        summary = {'profile': name, 'status': 'ok'}
+        try:
+            auto = Automation(name)
+            if sync_days is not None or incremental:
+                if not auto.sync(sync_days or 1, incremental):
+                    summary['status'] = 'sync failed'
+            if booking_days is not None:
+                auto.time_tracking(headless=True, days=booking_days, interactive=False)  # profiles share the terminal
+            summary.update(auto.summary)
+        except:
+            self.log(traceback.format_exc(), silent=False, level='error', profile=name)
+            summary['status'] = 'failed'
+        summary['duration'] = round(time.time() - started, 3)
+        return summary
+
+    def run(self, sync_days=None, booking_days=None, incremental=False):
+        """Runs all profiles concurrently and prints a summary table. Returns list of summaries."""
+        Core.shared = SharedData()
+        try:
+            with ThreadPoolExecutor(max_workers=min(self.workers, len(self.names)) or 1) as pool:
+                summaries = list(pool.map(
+                    lambda name: self.run_profile(name, sync_days, booking_days, incremental), self.names))
+        finally:
+            Core.shared = None
+        self.print_divider(30)
+        self.print("%-20s %-12s %9s %9s %9s" % ('profile', 'status', 'projects', 'booked', 'seconds'))
+        for summary in summaries:
+            self.print("%-20s %-12s %9i %9i %9.1f" % (
+                summary['profile'], summary['status'], summary.get('projects_created', 0),
+                summary.get('entries_booked', 0), summary['duration']))
+            self.log("Profile run finished.", **summary)
+        return summaries
@@ -0,0 +1,152 @@
+from core import Core
+from booking import Booking
+from concurrent.futures import ThreadPoolExecutor
+import datetime
+
+
+class Reconciler(Core):
+    """Finds FreshBooks entries and Toggl booked tags that got out of sync, and optionally fixes them.
+    FreshBooks entries are streamed into a hash index on (date, hours, notes), Toggl entries are merged
+    like they're booked and looked up in that index, so a run is linear in the number of entries.
+    If the journal knows the FreshBooks project an entry was booked in, only entries in that project match."""
+
+    def __init__(self, automation):
+        super(Reconciler, self).__init__(automation.profile)
+        self.automation = automation
+        self.fb = automation.get_service('freshbooks')
+        self.tg = automation.get_service('toggl')
+        self.booking = Booking(self.fb, self.tg)
+
+    def get_key(self, date, hours, notes):
+        """Returns join key of an entry, notes are normalized like FreshBooks stores them."""
+        return (date, round(float(hours), 2), self.normalize_notes(notes))
+
+    def index_freshbooks(self, date_from, date_to):
+        """Returns dictionary mapping join keys to lists of FreshBooks time entries between dates."""
+        index = {}
+        for entry in self.fb.iter_time_entries(date_from, date_to):
+            index.setdefault(self.get_key(entry['date'], entry['hours'], entry['notes']), []).append(entry)
+        return index
+
+    def run(self, days=7, end_date=None, fix=False):
+        """Reconciles entries of the past days (up to end_date, if specified). Reports orphans,
+        duplicates and missing tags, and fixes them if fix is True. Returns dictionary of findings."""
+        end_date = end_date or datetime.date.today()
+        date_from = str(end_date - datetime.timedelta(days=days - 1))
+        # Merged Toggl entries are dated by their UTC start (see merge_toggl_time_entries), but timestamps
+        # are local time, so fetch a day extra on both sides and only keep entries dated within the range:
+        timestamp = self.automation.get_timestamp(days + 1, end_date)
+        end_timestamp = self.automation.get_end_timestamp(end_date + datetime.timedelta(days=1))
+        self.print("Reconciling FreshBooks and Toggl entries from %s up to %s..." % (date_from, end_date))
+        # Fetch Toggl entries while FreshBooks entries are streamed into the index:
+        with ThreadPoolExecutor(max_workers=1) as pool:
+            toggl = pool.submit(lambda: self.automation.merge_toggl_time_entries(
+                self.tg.iter_time_entries(timestamp, end_timestamp)))
+            index = self.index_freshbooks(date_from, str(end_date))
+            time_entries = [e for e in toggl.result() if date_from <= e.date <= str(end_date)]
+        projects = self.tg.prefetch_projects(entry.pid for entry in time_entries)
+        findings = {'matched': 0, 'missing_tags': [], 'orphan_tags': [], 'conflicts': [], 'duplicates': [],
+                    'orphan_entries': []}
+        matched_keys = set()
+        unmatched = []  # tagged entries without FreshBooks entry, with the project they were booked in
+        for entry in time_entries:
+            hours = self.automation.get_hours(entry)
+            if not entry.billable or hours < 0.25:
+                continue  # never booked
+            description = self.automation.format_description(projects[entry.pid]['name'], entry.description)
+            key = self.get_key(entry.date, hours, description)
+            candidates = index.get(key, [])
+            # Only match FreshBooks entries in the project the journal says it was booked in, if known:
+            record = self.booking.journal.get(self.booking.get_key(entry.merged_ids), {})
+            project_id = record.get('entry', {}).get('project_id')
+            if project_id is not None:
+                candidates = [c for c in candidates if c['project_id'] == str(project_id)]
+            if not candidates:
+                if entry.booked:
+                    unmatched.append((entry, project_id, projects[entry.pid]['name']))
+                continue
+            match = candidates[0]
+            index[key].remove(match)
+            matched_keys.add(key + (match['project_id'],))
+            findings['matched'] += 1
+            if not entry.booked:
+                findings['missing_tags'].append(entry)  # in FreshBooks, but not tagged
+        # Left over entries are duplicates if an entry with the same key in the same project matched:
+        for key, entries in index.items():
+            for entry in entries:
+                is_duplicate = key + (entry['project_id'],) in matched_keys
+                findings['duplicates' if is_duplicate else 'orphan_entries'].append(entry)
+        self.find_conflicts(findings, unmatched)
+        self.print_findings(findings)
+        if fix:
+            self.fix(findings)
+        return findings
+
+    def find_conflicts(self, findings, unmatched):
+        """Sorts tagged entries without FreshBooks entry into orphan tags and conflicts.
+        It's a conflict if the journal says the entry was booked, or if FreshBooks has an unmatched entry
+        on the same date in the same project (e.g. notes or hours edited in FreshBooks). Those are only
+        reported, untagging them would book them a second time."""
+        orphan_entries = {}
+        for fb_entry in findings['orphan_entries']:
+            orphan_entries.setdefault(fb_entry['date'], []).append(fb_entry)
+        related_ids = set()
+        for entry, project_id, project_name in unmatched:
+            if project_id is not None:
+                related = [e for e in orphan_entries.get(entry.date, []) if e['project_id'] == str(project_id)]
+            else:  # notes start with the Toggl project name, see Automation.format_description
+                prefix = self.normalize_notes(project_name) + ' -'
+                related = [e for e in orphan_entries.get(entry.date, [])
+                           if self.normalize_notes(e['notes']).startswith(prefix)]
+            if related or self.booking.get_status(entry.merged_ids) in ('booked', 'tagged'):
+                findings['conflicts'].append((entry, related))
+                related_ids.update(e['time_entry_id'] for e in related)
+            else:
+                findings['orphan_tags'].append(entry)  # tagged, but not in FreshBooks
+        findings['orphan_entries'] = [e for e in findings['orphan_entries'] if e['time_entry_id'] not in related_ids]
+
+    def print_findings(self, findings):
+        """Prints what reconciliation found."""
+        self.print_divider(30)
+        self.print("%i entries are in sync." % findings['matched'], 'ok')
+        for entry in findings['missing_tags']:
+            self.print("Missing tag: %s, %s (Toggl ids: %s)" % (
+                entry.date, entry.description, ','.join(str(i) for i in entry.merged_ids)), 'warn')
+        for entry in findings['orphan_tags']:
+            self.print("Tagged but not in FreshBooks: %s, %s (Toggl ids: %s)" % (
+                entry.date, entry.description, ','.join(str(i) for i in entry.merged_ids)), 'warn')
+        for entry, related in findings['conflicts']:
+            self.print("Conflict, please check by hand: %s, %s (Toggl ids: %s) is booked, but FreshBooks has %s" % (
+                entry.date, entry.description, ','.join(str(i) for i in entry.merged_ids),
+                ', '.join("'%s' (%s hours, id %s)" % (e['notes'], e['hours'], e['time_entry_id']) for e in related)
+                or 'no matching entry'), 'warn')
+        for entry in findings['duplicates']:
+            self.print("Duplicate in FreshBooks: %s, %s hours, %s (id %s)" % (
+                entry['date'], entry['hours'], entry['notes'], entry['time_entry_id']), 'warn')
+        for entry in findings['orphan_entries']:
+            self.print("Not in Toggl: %s, %s hours, %s (id %s)" % (
+                entry['date'], entry['hours'], entry['notes'], entry['time_entry_id']), 'warn')
+
+    def fix(self, findings):
+        """Tags entries that are in FreshBooks, untags entries that aren't (so they get booked again)
+        and deletes duplicates (same key in the same project) from FreshBooks.
+        Entries only in FreshBooks and conflicts are left alone, they could have been added or edited by hand."""
+        self.print_divider(30)
+        if findings['missing_tags']:
+            ids = [i for entry in findings['missing_tags'] for i in entry.merged_ids]
+            tagged = self.tg.tag_projects(ids, self.tg.BOOKED_TAG)
+            for entry in findings['missing_tags']:
+                if all(i in tagged for i in entry.merged_ids):
+                    self.booking.write_journal(self.booking.get_key(entry.merged_ids), 'tagged')
+        if findings['orphan_tags']:
+            ids = [i for entry in findings['orphan_tags'] for i in entry.merged_ids]
+            untagged = self.tg.tag_projects(ids, self.tg.BOOKED_TAG, remove=True)
+            for entry in findings['orphan_tags']:
+                if all(i in untagged for i in entry.merged_ids):
+                    self.booking.write_journal(self.booking.get_key(entry.merged_ids), 'untagged')
+        if findings['duplicates']:
+            with ThreadPoolExecutor(max_workers=self.workers) as pool:
+                list(pool.map(lambda entry: self.fb.delete_entry(entry['time_entry_id']), findings['duplicates']))
+            self.print("Deleted %i duplicates from FreshBooks." % len(findings['duplicates']), 'ok')
+        self.log("Reconciliation fixed %i missing tags, %i orphan tags and %i duplicates." % (
+            len(findings['missing_tags']), len(findings['orphan_tags']), len(findings['duplicates'])))
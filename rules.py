@@ -0,0 +1,51 @@
+from core import Core
+from fuzzywuzzy import fuzz
+import json
+import re
+
+
+class Rules(Core):
+    """Maps Toggl clients and projects to FreshBooks projects, so entries can be booked without prompts."""
+
+    def __init__(self, profile=None):
+        super(Rules, self).__init__(profile)
+        self.rules = self.load_rules()
+
+    def load_rules(self):
+        """Loads rules from rules file (see rules.json.example). Returns list of rules."""
+        try:
+            with open(self.rules_path, 'r') as rules_file:
+                rules = json.load(rules_file)
+        except IOError:
+            self.print("Couldn't find rules file '%s', every entry will be asked for." % self.rules_path, 'warn')
+            return []
+        for rule in rules:
+            rule.setdefault('match', 'exact')
+            rule.setdefault('score', 90)
+            rule.setdefault('task_id', 2)
+            if rule['match'] == 'regex':
+                rule['patterns'] = {field: re.compile(rule[field], re.IGNORECASE)
+                                    for field in ('client', 'project') if rule.get(field)}
+            elif rule['match'] not in ('exact', 'fuzzy'):
+                raise ValueError("Unknown match type '%s' in rules file!" % rule['match'])
+        return rules
+
+    def matches(self, rule, field, value):
+        """Checks if value (Toggl client or project name) matches field of rule."""
+        if not rule.get(field):
+            return True  # field not used by this rule
+        if not value:
+            return False
+        if rule['match'] == 'exact':
+            return rule[field] == value
+        elif rule['match'] == 'regex':
+            return bool(rule['patterns'][field].search(value))
+        else:
+            return fuzz.WRatio(rule[field], value) >= rule['score']
+
+    def resolve(self, client_name, project_name):
+        """Returns first rule matching Toggl client and project name, or None if no rule matches."""
+        for rule in self.rules:
+            if self.matches(rule, 'client', client_name) and self.matches(rule, 'project', project_name):
+                return rule
+        return None
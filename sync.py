@@ -1,11 +1,6 @@
-# Create Toggl projects based on Zendesk tickets
-from main import Automation
+# Create Toggl projects based on Zendesk tickets, same as 'python cli.py sync'
+from cli import main, convert_profiles
 import sys
 
 if __name__ == '__main__':
-    try:
-        days = int(sys.argv[1])
-    except:
-        days = 1
-    auto = Automation()
-    auto.sync(days)
\ No newline at end of file
+    sys.exit(main(['sync'] + convert_profiles(sys.argv[1:])))
@@ -1,6 +1,6 @@
-# Start timetracking in Freshbooks based on your Toggl entries
-from main import Automation
+# Start timetracking in Freshbooks based on your Toggl entries, same as 'python cli.py track'
+from cli import main, convert_profiles
+import sys
 
 if __name__ == '__main__':
-    auto = Automation()
-    auto.time_tracking()
+    sys.exit(main(['track'] + convert_profiles(sys.argv[1:])))
@@ -1,33 +1,52 @@
 from core import Core
-import requests
+from cache import Cache
+import datetime
 import json
+import threading
+from concurrent.futures import ThreadPoolExecutor
 
 
 class Toggl(Core):
     """Contains all Toggl related operations."""
 
-    def __init__(self):
-        super(Toggl, self).__init__()
-        self.BOOKED_TAG = "\U0001F343"  # tag used for flagging Toggl projects
+    BOOKED_TAG = "\U0001F343"  # tag used for flagging Toggl projects
+    TAG_URL_LIMIT = 2000  # max length of tag URLs, servers reject long URLs
+    TIME_ENTRY_LIMIT = 1000  # max number of time entries the API returns per request
+
+    def __init__(self, profile=None):
+        super(Toggl, self).__init__(profile)
+        self.session = self.get_session('toggl')
+        self.cache = Cache(profile)  # persistent cache for clients and projects
         self.clients = None  # will contain loaded Toggl clients
+        self.client_names = None  # will contain client id to name mapping
         self.projects = None  # will contain loaded Toggl projects
+        self.projects_by_id = None  # will contain project id to project mapping
+        self.project_index = None  # will contain Zendesk ticket id to Toggl project mapping
+        self.lock = threading.Lock()
+        self.client_locks = {}  # one lock per client name, so each client is only created once
 
     def get_clients(self):
         """Returns dictionary of all Toggl clients with key/value name/id."""
         if self.clients:
             return self.clients
-        else:
-            return self.load_clients()
+        clients = self.cache.get('toggl_clients')
+        if clients is not None:
+            self.clients = clients
+            self.client_names = None
+            return clients
+        return self.load_clients()
 
     def load_clients(self):
         """Loads Toggl clients from their API and saves them to object."""
         self.print("Loading Toggl clients...")
         url = 'https://www.toggl.com/api/v8/clients'
-        response = requests.get(url, auth=self.toggl_creds).json()
+        response = self.session.get(url, auth=self.toggl_creds).json()
         clients = {}
         for result in response:
             clients[result['name']] = result['id']
         self.clients = clients  # store for later use
+        self.client_names = None
+        self.cache.set('toggl_clients', clients)
         return clients
 
     def get_client_id(self, name=None, project_id=None):
@@ -35,7 +54,7 @@ class Toggl(Core):
            Uses fuzzy matching for matching names."""
         if project_id:
             url = 'https://www.toggl.com/api/v8/projects/' + str(project_id)
-            response = requests.get(url, auth=self.toggl_creds)
+            response = self.session.get(url, auth=self.toggl_creds)
             return response.json()['data'].get('cid')
         elif name:
             if self.get_clients().get(name):
@@ -53,10 +72,9 @@ class Toggl(Core):
 
     def get_client_name(self, client_id):
         """Returns name of Toggl client, accepts Toggl client id."""
-        for name, _id in self.get_clients().items():
-            if client_id == _id:
-                return name
-        return None
+        if self.client_names is None:
+            self.client_names = {_id: name for name, _id in self.get_clients().items()}
+        return self.client_names.get(client_id)
 
     def create_client(self, name, workspace_id=None):
         """Creates a new Toggl client. Returns Toggl's JSON response.
@@ -76,20 +94,44 @@ class Toggl(Core):
             }
         data = json.dumps(data)
         url = 'https://www.toggl.com/api/v8/clients'
-        response = requests.post(url, headers=headers, data=data, auth=self.toggl_creds)
+        response = self.session.post(url, headers=headers, data=data, auth=self.toggl_creds)
         client = response.json()['data']
-        self.load_clients()
+        self.cache.invalidate('toggl_clients')
+        if self.clients is not None:
+            self.clients[client['name']] = client['id']
+            self.client_names = None
         return client
 
+    def get_or_create_client(self, name):
+        """Returns id of Toggl client with (fuzzy matched) name, creates the client if there is none.
+        If Toggl refuses to create it, clients are reloaded and looked up once more.
+        Safe to call from multiple threads, every name is only resolved once at a time."""
+        with self.lock:
+            client_lock = self.client_locks.setdefault(name, threading.Lock())
+        with client_lock:
+            client_id = self.get_client_id(name=name)
+            if not client_id:
+                from requests import HTTPError  # only load requests when it's needed
+                try:
+                    client_id = self.create_client(name)['id']
+                except HTTPError:
+                    # Client may have been created elsewhere since the clients were cached, look again:
+                    self.load_clients()
+                    client_id = self.get_client_id(name=name)
+                    if not client_id:
+                        raise
+            return client_id
+
     def get_project(self, project_id):
         """Returns Toggl project in json format. Accepts project id."""
         url = 'https://www.toggl.com/api/v8/projects/' + str(project_id)
-        response = requests.get(url, auth=self.toggl_creds)
+        response = self.session.get(url, auth=self.toggl_creds)
         return response.json()['data']
 
     def create_project(self, title, client_id=None, is_private=True):
         """Creates Toggl project with specified title and (optional) client id.
-            Returns API response in json (if possible)."""
+            Returns API response in json (if possible), or Toggl's error if the name is already taken.
+            Other errors raise HTTPError."""
         headers = {
             'Content-Type': 'application/json',
             }
@@ -102,54 +144,217 @@ class Toggl(Core):
             }
         data = json.dumps(data)
         url = 'https://www.toggl.com/api/v8/projects'
-        response = requests.post(url, headers=headers, data=data, auth=self.toggl_creds)
+        from requests import HTTPError  # only load requests when it's needed
+        try:
+            response = self.session.post(url, headers=headers, data=data, auth=self.toggl_creds)
+        except HTTPError as error:
+            if error.response.status_code == 400 and 'already been taken' in error.response.text:
+                return error.response.text  # e.g. project of an archived ticket, logged by caller
+            raise
+        self.cache.invalidate('toggl_projects')
         try:
-            return response.json()
+            result = response.json()
         except:
             return response.text
+        if result.get('data'):
+            self.add_project(result['data'])
+        return result
+
+    def add_project(self, project):
+        """Adds newly created project to loaded projects and ticket index."""
+        with self.lock:
+            if self.projects is not None:
+                self.projects.append(project)
+            if self.projects_by_id is not None:
+                self.projects_by_id[project['id']] = project
+            if self.project_index is not None:
+                self.index_project(project)
 
-    def tag_projects(self, id_list, tag=None):
-        """Tags Toggl time entries. Accepts list of toggl time entry IDs and tag."""
+    def prefetch_projects(self, project_ids):
+        """Makes sure all specified projects are loaded, so they can be looked up without API calls.
+        Projects not visible in get_projects are fetched concurrently.
+        Returns dictionary mapping project id to project."""
+        if self.projects_by_id is None:
+            self.projects_by_id = {p['id']: p for p in self.get_projects()}
+        missing = set(_id for _id in project_ids if _id and _id not in self.projects_by_id)
+        if missing:
+            with ThreadPoolExecutor(max_workers=self.workers) as pool:
+                for project in pool.map(self.get_project, missing):
+                    if project:
+                        self.projects_by_id[project['id']] = project
+        return self.projects_by_id
+
+    def refresh(self):
+        """Reloads clients and (incrementally) projects, keeps long running processes up to date."""
+        self.load_clients()
+        projects = self.load_projects()
+        with self.lock:
+            self.projects = projects
+            self.projects_by_id = None
+            self.project_index = None
+
+    def get_project_index(self):
+        """Returns dictionary mapping Zendesk ticket ids (as string) to Toggl projects.
+        Relies on project names starting with '#<ticket id>', see Automation.format_title."""
+        if self.project_index is None:
+            self.project_index = {}
+            for project in self.get_projects():
+                self.index_project(project)
+        return self.project_index
+
+    def index_project(self, project):
+        """Adds project to ticket index if its name starts with a ticket id."""
+        words = project.get('name', '').split()
+        if words and words[0].startswith('#'):
+            self.project_index[words[0][1:]] = project
+
+    def tag_projects(self, id_list, tag=None, retries=2, remove=False):
+        """Tags Toggl time entries. Accepts list of toggl time entry IDs and tag.
+        IDs are sent in chunks that fit in a URL, concurrently. Chunks are verified with the
+        response and failed IDs are retried. Returns set of IDs that are tagged
+        (or untagged, if remove is True)."""
         if not tag:
             tag = self.BOOKED_TAG
+        remaining = list(dict.fromkeys(id_list))  # unique, in order
+        tagged = set()
+        for attempt in range(retries + 1):
+            chunks = self.get_tag_chunks(remaining)
+            with ThreadPoolExecutor(max_workers=self.workers) as pool:
+                for result in pool.map(lambda chunk: self.tag_chunk(chunk, tag, remove), chunks):
+                    tagged.update(result)
+            remaining = [i for i in remaining if i not in tagged]
+            if not remaining:
+                break
+        if tagged:
+            self.print('%s %i Toggl %s. ' % ('Untagged' if remove else 'Tagged', len(tagged),
+                                             'entry' if len(tagged) == 1 else 'entries') + tag, 'ok')
+        if remaining:
+            self.log("Couldn't tag %i Toggl entries: %s" % (len(remaining), ','.join(str(i) for i in remaining)),
+                     silent=False, level='error', service='toggl', endpoint='time_entries')
+        return tagged
+
+    def get_tag_chunks(self, id_list):
+        """Splits list of time entry IDs in chunks that keep tag URLs below TAG_URL_LIMIT."""
+        space = self.TAG_URL_LIMIT - len(self.get_tag_url([]))
+        chunks = []
+        chunk, length = [], 0
+        for entry_id in id_list:
+            id_length = len(str(entry_id)) + (1 if chunk else 0)  # plus comma
+            if chunk and length + id_length > space:
+                chunks.append(chunk)
+                chunk, length = [], 0
+                id_length -= 1
+            chunk.append(entry_id)
+            length += id_length
+        if chunk:
+            chunks.append(chunk)
+        return chunks
+
+    def get_tag_url(self, id_list):
+        """Returns URL for updating multiple time entries at once."""
+        return 'https://www.toggl.com/api/v8/time_entries/' + ','.join(str(i) for i in id_list)
+
+    def tag_chunk(self, id_list, tag, remove=False):
+        """Tags (or untags) a single chunk of time entries.
+        Returns set of IDs the response says are tagged (or untagged)."""
         headers = {
             'Content-Type': 'application/json',
             }
         data = {
             "time_entry": {
-                "tags": [tag]
+                "tags": [tag],
+                "tag_action": "remove" if remove else "add"
                 }
             }
         data = json.dumps(data)
-        url = 'https://www.toggl.com/api/v8/time_entries/' + ','.join(str(i) for i in id_list)
-        response = requests.post(url, headers=headers, data=data, auth=self.toggl_creds)
-        self.print('Tagged Toggl %s. ' % ('entry' if len(id_list) == 1 else 'entries') + self.BOOKED_TAG, 'ok')
-        return response.json()
+        try:
+            response = self.session.post(self.get_tag_url(id_list), headers=headers, data=data,
+                                         auth=self.toggl_creds)
+            entries = response.json()['data']
+        except Exception as error:
+            self.log("Tagging %i Toggl entries failed: %r" % (len(id_list), error), level='warning',
+                     service='toggl', endpoint='time_entries')
+            return set()
+        requested = set(id_list)
+        return set(entry['id'] for entry in entries or []
+                   if entry['id'] in requested and (tag in (entry.get('tags') or ())) != remove)
 
     def get_projects(self):
-        """Retrieves and returns all projects visible to current user as array of JSON objects."""
+        """Retrieves and returns all projects visible to current user as array of JSON objects.
+        Uses the persistent cache, stale caches are refreshed incrementally."""
         if self.projects:
             return self.projects
-        self.print("Loading Toggl projects...")
+        projects = self.cache.get('toggl_projects')
+        if projects is None:
+            projects = self.load_projects()
+        self.projects = projects  # save for later
+        return projects
+
+    def load_projects(self):
+        """Loads Toggl projects from their API and saves them to cache.
+        If projects were cached before, only fetches projects changed since then."""
+        cached_projects, since = self.cache.get_entry('toggl_projects')
         params = {'with_related_data': 'true'}
+        if cached_projects is not None and since:
+            self.print("Refreshing Toggl projects...")
+            params['since'] = int(since)
+        else:
+            self.print("Loading Toggl projects...")
+            cached_projects = []
         url = 'https://www.toggl.com/api/v8/me'
-        response = requests.get(url, params=params, auth=self.toggl_creds)
-        projects = response.json()['data']['projects']
-        self.projects = projects  # save for later
+        response = self.session.get(url, params=params, auth=self.toggl_creds).json()
+        projects = {p['id']: p for p in cached_projects}
+        for project in response['data'].get('projects') or []:
+            if project.get('server_deleted_at'):
+                projects.pop(project['id'], None)
+            else:
+                projects[project['id']] = project
+        projects = list(projects.values())
+        self.cache.set('toggl_projects', projects, fetched_at=response.get('since'))
         return projects
 
-    def get_time_entries(self, timestamp):
+    def get_time_entries(self, timestamp, end_timestamp=None):
         """Returns all Toggl time entries from specified starting point as json array.
         Timestamp should be in isoformat including timezone info."""
+        return list(self.iter_time_entries(timestamp, end_timestamp))
+
+    def iter_time_entries(self, timestamp, end_timestamp=None):
+        """Generator yielding all Toggl time entries between two timestamps (isoformat including tz).
+        The range is split into windows that are fetched concurrently, so long ranges don't get
+        truncated by the maximum number of entries the API returns. End defaults to now."""
         self.print("Loading Toggl time entries...")
-        params = {'start_date': timestamp}
-        response = requests.get('https://www.toggl.com/api/v8/time_entries', params=params, auth=self.toggl_creds)
+        start = datetime.datetime.fromisoformat(timestamp)
+        if end_timestamp:
+            end = datetime.datetime.fromisoformat(end_timestamp)
+        else:
+            end = datetime.datetime.now(start.tzinfo)
+        windows = []
+        while start < end:
+            window_end = min(start + datetime.timedelta(days=self.time_entry_window), end)
+            windows.append((start, window_end))
+            start = window_end
+        seen = set()  # entries on window boundaries could show up twice
+        with ThreadPoolExecutor(max_workers=self.workers) as pool:
+            for time_entries in pool.map(lambda window: self.get_time_entries_window(*window), windows):
+                for entry in time_entries:
+                    if entry['id'] not in seen:
+                        seen.add(entry['id'])
+                        yield entry
+
+    def get_time_entries_window(self, start, end):
+        """Returns Toggl time entries between two datetimes.
+        Splits window in half if the API's maximum number of entries is reached."""
+        params = {'start_date': start.isoformat(), 'end_date': end.isoformat()}
+        response = self.session.get('https://www.toggl.com/api/v8/time_entries', params=params, auth=self.toggl_creds)
         time_entries = response.json()
+        if len(time_entries) >= self.TIME_ENTRY_LIMIT and end - start > datetime.timedelta(minutes=1):
+            middle = start + (end - start) / 2
+            return self.get_time_entries_window(start, middle) + self.get_time_entries_window(middle, end)
         return time_entries
 
     def get_workspaces(self):
         """Fetches all Toggl workspaces. Returns list of (json) workspaces."""
         url = 'https://www.toggl.com/api/v8/workspaces'
-        response = requests.get(url, auth=self.toggl_creds)
+        response = self.session.get(url, auth=self.toggl_creds)
         workspaces = response.json()
         return workspaces
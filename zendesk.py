@@ -1,21 +1,120 @@
 from core import Core
-from zenpy import Zenpy
 import datetime
-import requests
 import json
+import os
+import time
+
+
+class TicketRecord():
+    """Compact record of a Zendesk ticket, holds only what the automation uses."""
+
+    __slots__ = ('id', 'subject', 'organization_id', 'organization_name', 'status', 'created_at', 'updated_at',
+                 'generated_timestamp')
+
+    def __init__(self, ticket, organization_name=None):
+        self.id = ticket['id']
+        self.subject = ticket.get('subject')
+        self.organization_id = ticket.get('organization_id')
+        self.organization_name = organization_name
+        self.status = ticket.get('status')
+        self.created_at = ticket.get('created_at')  # ISO timestamps, e.g. '2018-03-31T12:00:00Z'
+        self.updated_at = ticket.get('updated_at')
+        self.generated_timestamp = ticket.get('generated_timestamp')  # only set by incremental export
 
 
 class Zendesk(Core):
     """Contains all Zendesk related operations."""
 
-    def __init__(self):
-        super(Zendesk, self).__init__()
-        self.client = Zenpy(**self.zen_creds)  # initialize client connection to Zendesk
+    def __init__(self, profile=None):
+        super(Zendesk, self).__init__(profile)
+        # Credentials are stored in the session, so every account and user gets its own:
+        self.session = self.get_session('zendesk', (self.zen_creds['email'], self.zen_creds['subdomain']))
+        self.session.auth = ('%s/token' % self.zen_creds['email'], self.zen_creds['token'])
+        self.base_url = 'https://%s.zendesk.com/api/v2' % self.zen_creds['subdomain']
+        self.organizations = {}  # organization id -> name, kept for the whole run
 
     def get_tickets(self, days=1):
-        """Returns array of ticket objects for past X days."""
+        """Returns array of ticket records for past X days."""
+        return list(self.iter_tickets(days))
+
+    def iter_tickets(self, days=1):
+        """Generator yielding ticket records created in the past X days."""
         yesterday = datetime.datetime.now() - datetime.timedelta(days=days)
-        tickets = []
-        for ticket in self.client.search(type="ticket", created_greater_than=(yesterday)):
-            tickets.append(ticket)
-        return tickets
+        params = {
+            'query': 'type:ticket created>%s' % yesterday.strftime('%Y-%m-%dT%H:%M:%SZ'),
+            'include': 'tickets(organizations)',  # sideload organizations of the tickets
+            }
+        search = lambda: self.iter_pages(self.base_url + '/search.json', params, 'results')
+        if self.shared is not None:
+            # Profiles with the same Zendesk only search once:
+            key = ('zendesk_tickets', self.zen_creds['subdomain'], days)
+            search_once = lambda: list(search())
+            for ticket in self.get_shared(key, search_once):
+                yield ticket
+        else:
+            for ticket in search():
+                yield ticket
+
+    def iter_new_tickets(self, start_time=None):
+        """Generator yielding tickets created or updated since the last processed ticket,
+        or since start_time (unix timestamp) if specified.
+        Uses Zendesk's incremental ticket export, see mark_processed."""
+        start_time = start_time or self.read_mark()
+        if not start_time:
+            start_time = int(time.time()) - 24 * 60 * 60  # first run, start a day back
+        params = {'start_time': start_time, 'include': 'organizations'}
+        url = self.base_url + '/incremental/tickets/cursor.json'
+        for ticket in self.iter_pages(url, params, 'tickets'):
+            if ticket.status != 'deleted':
+                yield ticket
+
+    def iter_pages(self, url, params, key):
+        """Generator yielding ticket records of all pages of a list (key being 'results' or 'tickets').
+        Organization names come from sideloaded organizations, missing ones are fetched in bulk per page."""
+        while url:
+            response = self.session.get(url, params=params)
+            page = response.json()
+            for organization in page.get('organizations') or []:
+                self.organizations[organization['id']] = organization['name']
+            tickets = [ticket for ticket in page.get(key) or [] if ticket.get('result_type', 'ticket') == 'ticket']
+            self.load_organizations(set(t['organization_id'] for t in tickets if t.get('organization_id')))
+            for ticket in tickets:
+                yield TicketRecord(ticket, self.organizations.get(ticket.get('organization_id')))
+            if page.get('end_of_stream'):
+                break
+            url = page.get('after_url') or page.get('next_page')  # includes query
+            params = None
+
+    def load_organizations(self, organization_ids):
+        """Adds names of organizations that aren't known yet, fetched 100 at a time."""
+        missing = sorted(i for i in organization_ids if i not in self.organizations)
+        for offset in range(0, len(missing), 100):
+            ids = ','.join(str(i) for i in missing[offset:offset + 100])
+            response = self.session.get(self.base_url + '/organizations/show_many.json', params={'ids': ids})
+            for organization in response.json().get('organizations') or []:
+                self.organizations[organization['id']] = organization['name']
+
+    def read_mark(self):
+        """Returns unix timestamp of last processed ticket, or None if there is none."""
+        try:
+            with open(self.zendesk_mark_path, 'r') as mark_file:
+                return json.load(mark_file)['timestamp']
+        except (IOError, ValueError, KeyError):
+            return None
+
+    def get_ticket_timestamp(self, ticket):
+        """Returns unix timestamp of last change of ticket, as used by the incremental export."""
+        if ticket.generated_timestamp:
+            return ticket.generated_timestamp
+        updated = datetime.datetime.strptime(ticket.updated_at, '%Y-%m-%dT%H:%M:%SZ')
+        return int(updated.replace(tzinfo=datetime.timezone.utc).timestamp())
+
+    def mark_processed(self, ticket):
+        """Advances high-water mark to ticket, so next incremental run starts from there.
+        Only call this after the ticket (and every ticket before it) has been processed."""
+        timestamp = self.get_ticket_timestamp(ticket)
+        if timestamp > (self.read_mark() or 0):
+            tmp_path = self.zendesk_mark_path + '.tmp'
+            with open(tmp_path, 'w') as mark_file:
+                json.dump({'timestamp': timestamp}, mark_file)
+            os.replace(tmp_path, self.zendesk_mark_path)